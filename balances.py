@@ -0,0 +1,157 @@
+import mmap
+import os
+import sys
+
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+from journal import INCLUDE, monthly_balances, read_journal
+from state import StateStore
+
+
+def journal_files(path: str) -> List[str]:
+    """The journal and the journals it includes, recursively."""
+
+    pending, files = [os.path.abspath(path)], []
+    while pending:
+        journal = pending.pop(0)
+        if journal in files:
+            continue
+        files.append(journal)
+
+        # Only journals that mention 'include' at all are read line by line
+        if not os.path.getsize(journal):
+            continue
+        with open(journal, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped.find(b'include') < 0:
+                continue
+
+        directory = os.path.dirname(journal)
+        with open(journal, 'r') as f:
+            for line in f:
+                m = INCLUDE.match(line)
+                if m:
+                    pending.append(os.path.join(
+                        directory, os.path.expanduser(m.group(1))))
+    return files
+
+
+def is_current(state: StateStore, journal: str) -> bool:
+    recorded = state.get_journal(state.key(journal))
+    return state.is_balanced(state.key(journal)) and recorded is not None \
+        and recorded[0] == os.path.getsize(journal)
+
+
+def rebuild(state: StateStore, journal: str) -> Dict[Tuple[str, str], int]:
+    totals = monthly_balances(read_journal(journal)[0])
+    key = state.key(journal)
+    with state.transaction():
+        if state.get_journal(key) is None:
+            state.set_journal(key, os.path.getsize(journal))
+        state.set_balances(key, totals.items())
+    return totals
+
+
+def _month(value: Optional[str]) -> Optional[str]:
+    if value is not None and not (len(value) == 7 and value[4] == '-'):
+        raise click.BadParameter(f'{value!r} is not a YYYY-MM month')
+    return value
+
+
+@click.group()
+def cli():
+    """Monthly account balances kept up to date by the importers."""
+
+
+@cli.command()
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+@click.option('--account', '-a', help='Per month for this account and its '
+                                      'subaccounts, e.g. Assets for the net '
+                                      'worth')
+@click.option('--begin', '-b', callback=lambda c, p, v: _month(v),
+              help='First month included, YYYY-MM')
+@click.option('--end', '-e', callback=lambda c, p, v: _month(v),
+              help='First month excluded, YYYY-MM')
+def show(journal, account, begin, end):
+    """Print balances from the stored monthly balances."""
+
+    state = StateStore()
+    files = journal_files(journal)
+    for path in files:
+        # Journals the importers never wrote only matter with entries
+        if not is_current(state, path) and (
+                state.get_journal(state.key(path)) is not None or
+                read_journal(path)[0]):
+            click.echo(f'Balances of {path} are not up to date, run '
+                       f'rebuild first', err=True)
+
+    totals = state.balances([state.key(path) for path in files])
+    selected = {key: cents for key, cents in totals.items()
+                if (begin is None or key[1] >= begin) and
+                (end is None or key[1] < end)}
+
+    if account:
+        months: Dict[str, int] = {}
+        for (name, month), cents in selected.items():
+            if name == account or name.startswith(account + ':'):
+                months[month] = months.get(month, 0) + cents
+        # The running balance includes everything before the first month
+        balance = sum(cents for (name, month), cents in totals.items()
+                      if begin is not None and month < begin and
+                      (name == account or name.startswith(account + ':')))
+        for month, cents in sorted(months.items()):
+            balance += cents
+            click.echo(f'{month}  €{Decimal(cents).scaleb(-2):>12.2f}'
+                       f'  €{Decimal(balance).scaleb(-2):>12.2f}')
+        return
+
+    accounts: Dict[str, int] = {}
+    for (name, _), cents in selected.items():
+        accounts[name] = accounts.get(name, 0) + cents
+    for name, cents in sorted(accounts.items()):
+        if cents:
+            click.echo(f'{name:<38s}  €{Decimal(cents).scaleb(-2):.2f}')
+
+
+@cli.command()
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+def verify(journal):
+    """Compare the stored balances with balances counted from scratch."""
+
+    state = StateStore()
+    ok = True
+    for path in journal_files(journal):
+        expected = {k: v for k, v in
+                    monthly_balances(read_journal(path)[0]).items() if v}
+        stored = {k: v for k, v in state.balances([state.key(path)]).items()
+                  if v}
+
+        for account, month in sorted(set(expected) | set(stored)):
+            if expected.get((account, month)) != \
+                    stored.get((account, month)):
+                ok = False
+                click.echo(f'{path}: {month} {account}: stored '
+                           f'{stored.get((account, month), 0)}, counted '
+                           f'{expected.get((account, month), 0)} cents')
+
+    click.echo('Balances are up to date' if ok else
+               'Balances differ, run rebuild to correct them')
+    sys.exit(0 if ok else 1)
+
+
+@cli.command('rebuild')
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+def rebuild_command(journal):
+    """Count the balances of a journal and its includes from scratch."""
+
+    state = StateStore()
+    for path in journal_files(journal):
+        totals = rebuild(state, path)
+        click.echo(f'{path}: {len(totals)} account months')
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,189 @@
+import csv
+import random
+
+import click
+
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, Iterator, List, Sequence, TextIO, Tuple
+
+ING_HEADER = ['Datum', 'Naam / Omschrijving', 'Rekening', 'Tegenrekening',
+              'Code', 'Af Bij', 'Bedrag (EUR)', 'MutatieSoort',
+              'Mededelingen']
+
+Merchant = Tuple[int, str, str, str, int, int]
+
+# (weight, name, description, direction, minimum amount, maximum amount),
+# chosen so that every rule in rules.ING_RULES gets hit. The exception is
+# the VERENIGING INFORMATIEWETENSCH rule: its name contains the food
+# keyword 'eten', so the groceries rule always matches those rows first.
+MERCHANTS: List[Merchant] = [
+    (30, 'Albert Heijn 1234 AMSTERDAM', 'Pasvolgnr:001 Betaalautomaat',
+     'Af', 1, 80),
+    (10, 'Jumbo Amsterdam', 'Pasvolgnr:001 Betaalautomaat', 'Af', 1, 60),
+    (6, 'Lidl Sciencepark', 'Pasvolgnr:001 Betaalautomaat', 'Af', 1, 40),
+    (5, 'Thuisbezorgd.nl', 'Bestelling 12345', 'Af', 10, 40),
+    (4, 'McDonalds Centraal', 'Pasvolgnr:001 Betaalautomaat', 'Af', 3, 15),
+    (2, 'VERENIGING INFORMATIEWETENSCH.AMSTERDAM', 'Afschrijving POS',
+     'Af', 1, 10),
+    (1, 'VERENIGING INFORMATIEWETENSCH.AMSTERDAM', 'Contributie',
+     'Af', 10, 20),
+    (4, 'Gall & Gall 123', 'Pasvolgnr:001 Betaalautomaat', 'Af', 5, 40),
+    (1, 'ING Bank', 'Incasso Creditcard', 'Af', 20, 500),
+    (1, 'SIMYO', 'Factuur mobiel', 'Af', 10, 20),
+    (1, 'UNICEF', 'Maandelijkse donatie', 'Af', 5, 15),
+    (6, 'NS GROEP IZ NS REIZIGERS', 'OV-Chipkaart opladen', 'Af', 5, 50),
+    (1, 'Transip BV', 'Domeinnaam verlenging', 'Af', 5, 15),
+    (1, 'De Key', 'huur woning', 'Af', 400, 600),
+    (1, 'Zilveren Kruis', 'Zorgverzekering premie', 'Af', 100, 130),
+    (1, 'Centraal Beheer', 'Verzekering inboedel', 'Af', 5, 20),
+    (1, 'AEGON', 'Aansprakelijkheid premie', 'Af', 2, 10),
+    (1, 'Sportexpl.mij', 'USC sportkaart', 'Af', 50, 100),
+    (1, 'Basic Kappers', 'Pasvolgnr:001 Betaalautomaat', 'Af', 15, 30),
+    (1, 'Belastingdienst', 'Aanslag 2018', 'Af', 10, 300),
+    (1, 'Infomedics', 'Tandarts nota', 'Af', 20, 200),
+    (2, 'H & M 123', 'Pasvolgnr:001 Betaalautomaat', 'Af', 10, 80),
+    (1, 'Universiteit van Amsterdam', 'Collegegeld', 'Af', 1900, 2100),
+    (3, 'Tikkie', 'Betaalverzoek bioscoop', 'Af', 5, 30),
+    (3, 'Cafe De Zon', 'Pasvolgnr:001 Betaalautomaat', 'Af', 3, 25),
+    (8, 'Webshop BV', 'Bestelling 987654', 'Af', 5, 150),
+    (2, 'ING', 'naar Oranje spaarrekening', 'Af', 50, 500),
+    (2, 'ING', 'van Oranje spaarrekening', 'Bij', 50, 500),
+    (2, 'ST.STUDIEBEGELEIDING LDN', 'Salaris', 'Bij', 200, 800),
+    (2, 'HET ZWARTE FIETSENPLAN', 'Salaris', 'Bij', 200, 800),
+    (2, 'DUO Dienst Uitvoering Onderwijs', 'Studiefinanciering',
+     'Bij', 100, 900),
+    (1, 'Belastingdienst', 'Huurtoeslag', 'Bij', 100, 300),
+    (1, 'Belastingdienst', 'Zorgtoeslag', 'Bij', 50, 100),
+    (1, 'Universiteit van Amsterdam', 'Bestuursbeurs', 'Bij', 275, 275),
+    (2, 'J. Jansen', 'Betaalverzoek pizza', 'Bij', 5, 20),
+    (2, 'K. de Vries', 'eten vrijdag', 'Bij', 5, 20),
+    (4, 'P. Pietersen', 'Terugbetaling', 'Bij', 5, 100),
+]
+
+
+def weigh_merchants(weights: Dict[str, int], only: bool = False) \
+        -> List[Merchant]:
+    """Merchants with their weight changed by name.
+
+    A weight applies to every merchant whose name contains the key,
+    ignoring case. With ``only``, merchants not named get weight 0.
+    Merchants with weight 0 are left out.
+    """
+
+    merchants = []
+    for merchant in MERCHANTS:
+        weight = 0 if only else merchant[0]
+        for key, value in weights.items():
+            if key.lower() in merchant[1].lower():
+                weight = value
+        if weight:
+            merchants.append((weight, *merchant[1:]))
+
+    if not merchants:
+        raise ValueError('No merchants left to choose from')
+    return merchants
+
+
+def format_amount(amount: Decimal) -> str:
+    units, _, cents = f'{amount:.2f}'.partition('.')
+    groups = []
+    while len(units) > 3:
+        groups.insert(0, units[-3:])
+        units = units[:-3]
+    groups.insert(0, units)
+    return '.'.join(groups) + ',' + cents
+
+
+def ing_rows(count: int, seed: int = 0,
+             start: date = date(2015, 1, 1),
+             merchants: Sequence[Merchant] = MERCHANTS) \
+        -> Iterator[List[str]]:
+    """Yield ING export rows, newest first like the real exports."""
+
+    rng = random.Random(seed)
+    weights = [m[0] for m in merchants]
+    # Roughly five transactions per day
+    end = start + timedelta(days=max(count // 5, 1))
+
+    day = end
+    for _ in range(count):
+        if rng.random() < 0.2:
+            day -= timedelta(days=1)
+
+        _, name, description, direction, low, high = rng.choices(
+            merchants, weights)[0]
+        amount = Decimal(rng.randint(low * 100, high * 100)) / 100
+
+        yield [day.strftime('%Y%m%d'), name, 'NL00INGB0001234567',
+               'NL00RABO0123456789' if rng.random() < 0.5 else '',
+               'BA' if direction == 'Af' else 'GT', direction,
+               format_amount(amount), 'Betaalautomaat', description]
+
+
+def meesman_rows(count: int, seed: int = 0,
+                 start: date = date(2015, 1, 1)) -> Iterator[List[str]]:
+    """Yield a Meesman value series, one value per day."""
+
+    rng = random.Random(seed)
+    value = Decimal('1000.00')
+
+    for i in range(count):
+        value = max(value + Decimal(rng.randint(-2000, 2500)) / 100,
+                    Decimal(0))
+        yield [(start + timedelta(days=i)).isoformat(),
+               format_amount(value)]
+
+
+def write_ing_csv(f: TextIO, count: int, seed: int = 0,
+                  merchants: Sequence[Merchant] = MERCHANTS) -> None:
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+    writer.writerow(ING_HEADER)
+    writer.writerows(ing_rows(count, seed, merchants=merchants))
+
+
+def write_meesman_csv(f: TextIO, count: int, seed: int = 0) -> None:
+    writer = csv.writer(f, lineterminator='\r\n')
+    writer.writerow(['Date', 'Value'])
+    writer.writerows(meesman_rows(count, seed))
+
+
+@click.command()
+@click.option('--format', 'fmt', type=click.Choice(['ing', 'meesman']),
+              default='ing', show_default=True, help='Export format')
+@click.option('--rows', '-n', default=1000, show_default=True,
+              type=click.IntRange(min=0), help='Number of rows')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed, the same seed gives the same file')
+@click.option('--merchant', '-m', 'merchant_weights', multiple=True,
+              metavar='NAME=WEIGHT',
+              help='Weight of the merchants whose name contains NAME, 0 '
+                   'leaves them out, can be given multiple times')
+@click.option('--only', is_flag=True,
+              help='Only generate the merchants given with --merchant')
+@click.option('--output-csv', '-o', type=click.File(mode='w', lazy=True),
+              default='-', help='Output CSV file  [default: stdout]')
+def main(fmt, rows, seed, merchant_weights, only, output_csv):
+    """Generate a synthetic bank export for benchmarks."""
+
+    weights = {}
+    for value in merchant_weights:
+        name, _, weight = value.rpartition('=')
+        if not name or not weight.isdigit():
+            raise click.BadParameter(f'{value!r} is not NAME=WEIGHT',
+                                     param_hint="'--merchant'")
+        weights[name] = int(weight)
+
+    try:
+        merchants = weigh_merchants(weights, only)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if fmt == 'ing':
+        write_ing_csv(output_csv, rows, seed, merchants)
+    else:
+        write_meesman_csv(output_csv, rows, seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from datetime import datetime as dt
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import process_ing  # noqa: E402
+from generate import write_ing_csv, write_meesman_csv  # noqa: E402
+from rules import ING_RULES  # noqa: E402
+from state import StateStore  # noqa: E402
+from util import AssetAccounts, Ingest, write_journal  # noqa: E402
+
+DEFAULT_SIZES = '1000,10000,100000'
+
+# Fresh interpreters started per run of the startup benchmark
+STARTUP_RUNS = 10
+
+# Number of rows, or rows and seconds for benchmarks that time themselves
+BenchmarkResult = Union[int, Tuple[int, float]]
+
+
+class Fixture:
+    """Synthetic exports of one size in a scratch directory."""
+
+    def __init__(self, directory: str, rows: int, seed: int) -> None:
+        self.directory = directory
+        self.rows = rows
+        self.ing_csv = os.path.join(directory, f'ing-{rows}.csv')
+        self.meesman_csv = os.path.join(directory, f'meesman-{rows}.csv')
+
+        with open(self.ing_csv, 'w') as f:
+            write_ing_csv(f, rows, seed)
+        with open(self.meesman_csv, 'w') as f:
+            write_meesman_csv(f, rows, seed)
+
+        with open(self.ing_csv, 'r') as f:
+            self.parsed = list(process_ing.read_rows(f))
+
+    def scratch(self, name: str) -> str:
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            os.remove(path)
+        return path
+
+
+@contextlib.contextmanager
+def no_prompts():
+    # Answer every question with its default and hide all output
+    with mock.patch('click.confirm',
+                    lambda *args, default=False, **kwargs: default), \
+            mock.patch.object(process_ing, 'prompt',
+                              lambda *args, **kwargs: '', create=True), \
+            mock.patch('click.echo'), \
+            contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def bench_csv_parse(fixture: Fixture) -> int:
+    with open(fixture.ing_csv, 'r') as f:
+        return sum(1 for _ in process_ing.read_rows(f))
+
+
+def bench_meesman_parse(fixture: Fixture) -> int:
+    with open(fixture.meesman_csv, 'r') as f:
+        return sum(len(cents) for _, cents in Ingest(f).series().values())
+
+
+def bench_classify(fixture: Fixture) -> int:
+    for date, amount, name, comment in fixture.parsed:
+        ING_RULES.classify('{} - {}'.format(name, comment), amount)
+    return len(fixture.parsed)
+
+
+def bench_replay(fixture: Fixture) -> int:
+    rows = list(process_ing.export_rows(fixture.ing_csv, {}))
+    return len(process_ing.replay_rows(rows, ING_RULES))
+
+
+def bench_convert_transaction(fixture: Fixture) -> int:
+    state = StateStore(fixture.scratch('convert.sqlite'))
+    with open(fixture.scratch('convert.journal'), 'a+') as journal, \
+            no_prompts():
+        processor = process_ing.JournalProcessor(journal, state=state)
+        for transaction_id, (date, amount, name, comment) in \
+                enumerate(fixture.parsed):
+            processor.convert_transaction(amount, name, comment, date,
+                                          transaction_id)
+    state.close()
+    return len(fixture.parsed)
+
+
+def journal_entries(fixture: Fixture) -> List[process_ing.JournalEntry]:
+    entries = []
+    for transaction_id, (date, amount, name, comment) in \
+            enumerate(fixture.parsed):
+        account2 = ING_RULES.classify(
+            '{} - {}'.format(name, comment), amount).account
+        entries.append(process_ing.JournalEntry(
+            date, f'{date.year}-{transaction_id} - {name} - {comment}', [
+                process_ing.Account(AssetAccounts.BANK_PAYMENT_ACCOUNT,
+                                    amount),
+                process_ing.Account(account2, -amount)]))
+    return entries
+
+
+def bench_render(fixture: Fixture) -> Tuple[int, float]:
+    entries = journal_entries(fixture)
+
+    start = time.perf_counter()
+    for entry in entries:
+        entry.journal_str
+    return len(entries), time.perf_counter() - start
+
+
+def bench_render_bulk(fixture: Fixture) -> Tuple[int, float]:
+    entries = journal_entries(fixture)
+
+    start = time.perf_counter()
+    with open(fixture.scratch('render.journal'), 'w') as f:
+        write_journal(entries, f)
+    return len(entries), time.perf_counter() - start
+
+
+def bench_tracking(fixture: Fixture) -> int:
+    state = StateStore(fixture.scratch('tracking.sqlite'))
+    tracking_file = process_ing.TrackingFile(fixture.ing_csv, state)
+    for transaction_id in range(fixture.rows):
+        tracking_file.current_id = transaction_id
+    state.close()
+    return fixture.rows
+
+
+def bench_end_to_end(fixture: Fixture) -> int:
+    state = StateStore(fixture.scratch('process.sqlite'))
+    with open(fixture.ing_csv, 'r') as input_csv, \
+            open(fixture.scratch('process.journal'), 'a+') as journal, \
+            no_prompts():
+        process_ing.CSVProcessor(input_csv, journal, state=state,
+                                 batch=True).process()
+    state.close()
+    return fixture.rows
+
+
+def bench_startup(fixture: Fixture) -> Tuple[int, float]:
+    # Start the importer the way a cron job does, up to the point where it
+    # would read its input; the fixture size does not matter here
+    command = [sys.executable, os.path.join(ROOT, 'process_ing.py'),
+               'import', '--help']
+
+    start = time.perf_counter()
+    for _ in range(STARTUP_RUNS):
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return STARTUP_RUNS, time.perf_counter() - start
+
+
+BENCHMARKS: Dict[str, Callable[[Fixture], BenchmarkResult]] = {
+    'csv_parse': bench_csv_parse,
+    'meesman_parse': bench_meesman_parse,
+    'classify': bench_classify,
+    'replay': bench_replay,
+    'convert_transaction': bench_convert_transaction,
+    'render': bench_render,
+    'render_bulk': bench_render_bulk,
+    'tracking': bench_tracking,
+    'end_to_end': bench_end_to_end,
+    'startup': bench_startup,
+}
+
+
+def run_benchmark(fn: Callable[[Fixture], BenchmarkResult],
+                  fixture: Fixture, repeat: int) -> Dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(fixture)
+        elapsed = time.perf_counter() - start
+
+        if isinstance(result, tuple):
+            result, elapsed = result
+        timings.append(elapsed)
+
+    best = min(timings)
+    return {
+        'rows': result,
+        'seconds': best,
+        'rows_per_second': result / best if best else None,
+        'timings': timings,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline: Dict, threshold: float) -> bool:
+    previous = {(r['benchmark'], r['size']): r
+                for r in baseline['results']}
+    regressed = False
+
+    click.echo(f"\n{'benchmark':<22s}{'size':>10s}{'before':>12s}"
+               f"{'after':>12s}{'change':>10s}")
+    for r in results:
+        before = previous.get((r['benchmark'], r['size']))
+        if not before:
+            continue
+
+        change = r['seconds'] / before['seconds'] - 1
+        line = (f"{r['benchmark']:<22s}{r['size']:>10d}"
+                f"{before['seconds']:>11.3f}s{r['seconds']:>11.3f}s"
+                f"{change:>+10.1%}")
+        if change > threshold:
+            regressed = True
+            line = click.style(line, fg='red', bold=True)
+        click.echo(line)
+
+    return regressed
+
+
+@click.command()
+@click.option('--sizes', default=DEFAULT_SIZES, show_default=True,
+              help='Comma separated numbers of rows, e.g. '
+                   '1000,10000,100000,1000000,10000000')
+@click.option('--benchmark', '-b', 'names', multiple=True,
+              type=click.Choice(list(BENCHMARKS)),
+              help='Benchmark to run, can be given multiple times  '
+                   '[default: all]')
+@click.option('--repeat', '-r', default=3, show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of runs per benchmark, the fastest is reported')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed for the generated exports')
+@click.option('--output', '-o', default='benchmark_results.json',
+              show_default=True, type=click.Path(dir_okay=False),
+              help='JSON file the results are written to')
+@click.option('--compare', 'baseline', type=click.File(mode='r'),
+              help='Earlier results file to compare against')
+@click.option('--threshold', default=0.1, show_default=True,
+              help='Slowdown relative to --compare reported as regression')
+def main(sizes, names, repeat, seed, output, baseline, threshold):
+    """Benchmark the import pipeline on synthetic exports."""
+
+    names = names or list(BENCHMARKS)
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(s) for s in sizes.split(',')):
+            click.echo(f'Generating {size} rows')
+            fixture = Fixture(directory, size, seed)
+
+            for name in names:
+                result = run_benchmark(BENCHMARKS[name], fixture, repeat)
+                result.update(benchmark=name, size=size)
+                results.append(result)
+
+                click.echo(f"  {name:<22s}{result['seconds']:>10.3f}s"
+                           f"{result['rows_per_second'] or 0:>14,.0f} rows/s")
+
+    report = {
+        'created': dt.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    }
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f'Results written to {output}')
+
+    if baseline and compare(results, json.load(baseline), threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+import os
+import re
+import time
+
+from collections import Counter
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from enum import Enum
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Set,
+                    TextIO, Tuple, Union)
+
+import click
+
+from state import StateStore
+from stats import NO_STATS, Stats
+from util import Account, JournalEntry, render_journal
+
+
+class Durability(Enum):
+    NONE = 'none'
+    FLUSH = 'flush'
+    FSYNC = 'fsync'
+
+
+SQLITE_SYNCHRONOUS = {
+    Durability.NONE: 'OFF',
+    Durability.FLUSH: 'NORMAL',
+    Durability.FSYNC: 'FULL',
+}
+
+
+def writer_options(f):
+    for option in reversed([
+        click.option('--output-journal', '-o', required=True,
+                     type=click.File(mode='a+'),
+                     help='Output hledger journal file'),
+        click.option('--commit-every', default=100, show_default=True,
+                     type=click.IntRange(min=1),
+                     help='Number of journal entries written per commit'),
+        click.option('--commit-interval', default=1000, show_default=True,
+                     type=click.IntRange(min=0),
+                     help='Maximum time in milliseconds between commits'),
+        click.option('--durability', default=Durability.FLUSH.value,
+                     show_default=True,
+                     type=click.Choice([d.value for d in Durability]),
+                     help='How far each commit is pushed to disk: none '
+                          '(left to the OS), flush, or fsync'),
+        click.option('--partition-by-year', is_flag=True,
+                     help='Write the entries of every year to <year>.journal '
+                          'next to the output journal, which includes '
+                          'them'),
+    ]):
+        f = option(f)
+    return f
+
+
+def writer_kwargs(commit_every: int, commit_interval: int,
+                  durability: str, partition_by_year: bool) -> Dict[str, Any]:
+    return dict(commit_every=commit_every,
+                commit_interval=commit_interval / 1000,
+                durability=Durability(durability),
+                partition_by_year=partition_by_year)
+
+
+class JournalWriter:
+    """Buffered journal output committed together with the import state.
+
+    Written text and entries are kept in memory and appended to the
+    journal in groups, entries rendered together when appended,
+    every ``commit_every`` entries, every ``commit_interval`` seconds or
+    when ``commit`` is called explicitly (e.g. before prompting the user).
+    The callbacks passed to ``write`` update the import state and run in
+    the same state transaction that records the new journal size. The
+    postings of the entries written are added to the monthly balances in
+    that transaction as well.
+
+    Before appending, the state is marked as pending. If the import crashes
+    before the state is committed, the journal is cut back to the last
+    committed size when it is opened again, so the journal never contains
+    entries the tracking state does not know about. A commit whose state
+    transaction failed can be retried; the journal is cut back to the
+    pending size before the buffer is appended again. Leaving the writer
+    through an exception does not commit.
+    """
+
+    def __init__(self, journal: TextIO, state: StateStore,
+                 commit_every: int = 100, commit_interval: float = 1.0,
+                 durability: Durability = Durability.FLUSH,
+                 stats: Stats = NO_STATS) -> None:
+        self.journal = journal
+        self.state = state
+        self.stats = stats
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.durability = durability
+        self.key = state.key(journal.name)
+
+        self._buffer: List[Union[JournalEntry, str]] = []
+        self._callbacks: List[Callable[[], None]] = []
+        self._balances: Counter = Counter()
+        self._entries = 0
+        self._first_write = 0.0
+        # Journal size marked as pending while the buffer is appended
+        self._pending_size: Optional[int] = None
+
+        self.state.set_synchronous(SQLITE_SYNCHRONOUS[durability])
+        self._recover()
+
+    def _size(self) -> int:
+        return os.fstat(self.journal.fileno()).st_size
+
+    @property
+    def size(self) -> int:
+        """Size of the journal including what is not committed yet."""
+        return self._size() + len(render_journal(self._buffer).encode())
+
+    def _recover(self) -> None:
+        self.journal.flush()
+        size = self._size()
+        recorded = self.state.get_journal(self.key)
+
+        if recorded is not None and recorded[1] and size > recorded[0]:
+            # Entries of an interrupted commit, the state never saw them
+            os.ftruncate(self.journal.fileno(), recorded[0])
+            self.journal.seek(0, os.SEEK_END)
+            size = recorded[0]
+
+        self.state.set_journal(self.key, size)
+
+        if recorded is None or size != recorded[0] or \
+                not self.state.is_balanced(self.key):
+            # Changed outside of the importer, or from before the balances
+            # were kept: count the monthly balances from scratch
+            with self.stats.stage('balances'):
+                entries = read_journal(self.journal.name)[0] if size else []
+                self.state.set_balances(self.key,
+                                        monthly_balances(entries).items())
+
+    def write(self, text: Union[JournalEntry, str],
+              *callbacks: Callable[[], None], entry: bool = True,
+              source: Optional[JournalEntry] = None) -> None:
+        """Buffer a journal entry, or ``text`` rendered from the journal
+        entry ``source``."""
+
+        if isinstance(text, JournalEntry):
+            # Unbalanced entries fail here rather than in the commit
+            text._check()
+            source = text
+
+        if not self._buffer:
+            self._first_write = time.monotonic()
+
+        self._add(text, source)
+        self._callbacks.extend(callbacks)
+
+        if entry:
+            self._entries += 1
+
+        if self._entries >= self.commit_every or \
+                time.monotonic() - self._first_write >= self.commit_interval:
+            self.commit()
+
+    def _add(self, text: Union[JournalEntry, str],
+             source: Optional[JournalEntry]) -> None:
+        self._buffer.append(text)
+        if source is not None:
+            add_monthly_balances(self._balances, source)
+
+    def commit(self) -> None:
+        if not self._buffer:
+            return
+
+        self._append()
+        with self.stats.stage('tracking'), self.state.transaction():
+            self._record()
+        self._clear()
+
+    def _append(self) -> None:
+        # Appends the buffer to the journal, marked as pending in the state
+        if self._pending_size is None:
+            with self.stats.stage('tracking'):
+                size = self._size()
+                self.state.set_journal(self.key, size, pending=True)
+                self._pending_size = size
+        else:
+            # An earlier commit failed after (part of) the buffer was
+            # appended
+            self.journal.flush()
+            os.ftruncate(self.journal.fileno(), self._pending_size)
+            self.journal.seek(0, os.SEEK_END)
+
+        with self.stats.stage('render'):
+            text = render_journal(self._buffer)
+
+        with self.stats.stage('write'):
+            self.journal.write(text)
+            self.journal.flush()
+            if self.durability is Durability.FSYNC:
+                os.fsync(self.journal.fileno())
+
+    def _record(self) -> None:
+        # Runs in the state transaction that ends the pending state
+        for callback in self._callbacks:
+            callback()
+        if self._balances:
+            self.state.add_balances(self.key, self._balances.items())
+        self.state.set_journal(self.key, self._size())
+
+    def _clear(self) -> None:
+        # Runs once the state transaction is committed
+        self._pending_size = None
+        self._buffer = []
+        self._callbacks = []
+        self._balances = Counter()
+        self._entries = 0
+
+    def close(self) -> None:
+        self.commit()
+
+    def __enter__(self) -> 'JournalWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> Optional[bool]:
+        # What is not committed is written again by the next import
+        if exc_type is None:
+            self.close()
+        return None
+
+
+class PartitionedWriter:
+    """Journal output split into a journal per year.
+
+    Entries are written to ``<year>.journal`` next to the given journal,
+    which gets an ``include`` line for every partition. A partition is
+    only opened once an entry of its year is written, and text written
+    without an entry (like the header) goes at the top of every partition
+    the run writes to.
+
+    Commits work as in ``JournalWriter``, but cover all partitions: their
+    appends are recorded and the callbacks run, in the order they were
+    written, in one state transaction. The import state of the given
+    journal (``key``) is shared by all partitions.
+    """
+
+    def __init__(self, journal: TextIO, state: StateStore,
+                 commit_every: int = 100, commit_interval: float = 1.0,
+                 durability: Durability = Durability.FLUSH,
+                 stats: Stats = NO_STATS) -> None:
+        self.journal = journal
+        self.state = state
+        self.stats = stats
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.durability = durability
+        self.key = state.key(journal.name)
+        self.directory = os.path.dirname(os.path.abspath(journal.name))
+
+        self.partitions: Dict[int, JournalWriter] = {}
+        self._written: Set[int] = set()
+        self._includes: Optional[List[str]] = None
+        self._preamble: List[str] = []
+        self._callbacks: List[Callable[[], None]] = []
+        self._pending = False
+        self._entries = 0
+        self._first_write = 0.0
+
+        self.state.set_synchronous(SQLITE_SYNCHRONOUS[durability])
+
+        for year, path in self._existing():
+            recorded = self.state.get_journal(self.state.key(path))
+            if recorded is not None and recorded[1]:
+                # Cut back an interrupted commit right away, even when this
+                # run does not write to the partition
+                self._partition(year)
+
+    def _existing(self) -> List[Tuple[int, str]]:
+        """Year and path of the partitions on disk."""
+
+        existing = []
+        for name in os.listdir(self.directory):
+            m = PARTITION.match(name)
+            path = os.path.join(self.directory, name)
+            if m and self.state.key(path) != self.key:
+                existing.append((int(m.group(1)), path))
+        return sorted(existing)
+
+    def _partition(self, year: int) -> JournalWriter:
+        writer = self.partitions.get(year)
+        if writer is not None:
+            return writer
+
+        name = f'{year}.journal'
+        path = os.path.join(self.directory, name)
+        writer = JournalWriter(open(path, 'a+'), self.state,
+                               durability=self.durability, stats=self.stats)
+        self.partitions[year] = writer
+
+        if self._includes is None:
+            self._includes = [
+                os.path.join(self.directory, os.path.expanduser(i))
+                for i in read_includes(self.journal.name)]
+        if path not in self._includes:
+            self.journal.seek(0, os.SEEK_END)
+            self.journal.write(('\n' if self._unterminated() else '') +
+                               f'include {name}\n')
+            self.journal.flush()
+            self._includes.append(path)
+        return writer
+
+    def _unterminated(self) -> bool:
+        # Whether the journal ends in the middle of a line
+        if not os.fstat(self.journal.fileno()).st_size:
+            return False
+        with open(self.journal.name, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    @property
+    def size(self) -> int:
+        """Size of the journal and its partitions, including what is not
+        committed yet."""
+
+        return os.fstat(self.journal.fileno()).st_size + \
+            sum(os.path.getsize(path) for year, path in self._existing()
+                if year not in self.partitions) + \
+            sum(writer.size for writer in self.partitions.values())
+
+    def write(self, text: Union[JournalEntry, str],
+              *callbacks: Callable[[], None], entry: bool = True,
+              source: Optional[JournalEntry] = None) -> None:
+        """Buffer a journal entry, or ``text``, for the partition of the
+        journal entry ``source``."""
+
+        if isinstance(text, JournalEntry):
+            text._check()
+            source = text
+
+        if not self._pending:
+            self._first_write = time.monotonic()
+            self._pending = True
+
+        if source is None:
+            self._preamble.append(text)
+        else:
+            year = source.date.year
+            writer = self._partition(year)
+            if year not in self._written:
+                writer._add(''.join(self._preamble), None)
+                self._written.add(year)
+            writer._add(text, source)
+        self._callbacks.extend(callbacks)
+
+        if entry:
+            self._entries += 1
+
+        if self._entries >= self.commit_every or \
+                time.monotonic() - self._first_write >= self.commit_interval:
+            self.commit()
+
+    def commit(self) -> None:
+        if not self._pending:
+            return
+        touched = [w for w in self.partitions.values() if w._buffer]
+
+        for writer in touched:
+            writer._append()
+
+        with self.stats.stage('tracking'), self.state.transaction():
+            for callback in self._callbacks:
+                callback()
+            for writer in touched:
+                writer._record()
+        for writer in touched:
+            writer._clear()
+
+        self._callbacks = []
+        self._pending = False
+        self._entries = 0
+
+    def close(self) -> None:
+        self.commit()
+        for writer in self.partitions.values():
+            writer.journal.close()
+
+    def __enter__(self) -> 'PartitionedWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> Optional[bool]:
+        if exc_type is None:
+            self.close()
+        else:
+            for writer in self.partitions.values():
+                writer.journal.close()
+        return None
+
+
+def open_writer(journal: TextIO, state: StateStore,
+                partition_by_year: bool = False, **kwargs) \
+        -> Union[JournalWriter, PartitionedWriter]:
+    if partition_by_year:
+        return PartitionedWriter(journal, state, **kwargs)
+    return JournalWriter(journal, state, **kwargs)
+
+
+HEADER = re.compile(r'(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})'
+                    r'(?:=\S+)?\s+(?:[*!]\s*)?(?:\([^)]*\)\s*)?(.*)')
+POSTING = re.compile(r'\s+(?:[*!]\s*)?([^;\s](?:[^;\t]*?[^;\s])??)'
+                     r'(?:(?:\s{2,}|\t|(?=€))([^;=]*))?(?:=[^;]*)?(?:;.*)?$')
+TAG = re.compile(r'([^\s:,;]+):')
+INCLUDE = re.compile(r'include\s+(.+?)\s*$')
+PARTITION = re.compile(r'(\d{4})\.journal$')
+
+
+def read_includes(path: str) -> List[str]:
+    """Targets of the ``include`` directives of a journal, as written."""
+
+    with open(path, 'r') as f:
+        return [m.group(1) for m in map(INCLUDE.match, f) if m]
+
+
+def parse_amount_str(s: str) -> Optional[Decimal]:
+    s = s.replace('€', '').replace('EUR', '').replace(' ', '')
+    if not s:
+        return None
+    try:
+        return Decimal(s.replace(',', ''))
+    except InvalidOperation:
+        raise ValueError(f'Unsupported amount {s!r}')
+
+
+def _parse_entry(lines: List[str]) -> Optional[JournalEntry]:
+    m = HEADER.match(lines[0])
+    if not m:
+        # Directives, periodic and automated transactions
+        return None
+
+    year, month, day, description = m.groups()
+    description, sep, comment = description.partition(';')
+    entry = JournalEntry(date(int(year), int(month), int(day)),
+                         description.rstrip() if sep else description)
+    entry.tags = TAG.findall(comment)
+
+    missing = None
+    for line in lines[1:]:
+        if line.lstrip().startswith(';'):
+            continue
+        m = POSTING.match(line)
+        if not m:
+            raise ValueError(f'Unsupported posting {line!r}')
+
+        value = parse_amount_str(m.group(2) or '')
+        if value is None:
+            missing = len(entry.postings)
+        entry.postings.append(Account(m.group(1), value))
+
+    if missing is not None:
+        # hledger infers a single omitted amount from the others
+        rest = sum(p.value for i, p in enumerate(entry.postings)
+                   if i != missing)
+        entry.postings[missing] = Account(entry.postings[missing].name,
+                                          -rest)
+
+    return entry
+
+
+def parse_journal(lines: Iterable[str], includes: Optional[List[str]] = None
+                  ) -> Iterable[JournalEntry]:
+    """Parse the journal format written by ``JournalEntry.journal_str``.
+
+    Plain hledger journals are understood as far as the project uses
+    them: transactions with single-commodity postings, comments and tags.
+    Other directives are skipped; the targets of ``include`` directives
+    are appended to ``includes``.
+    """
+
+    block: List[str] = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if line[:1].isspace() and line.strip():
+            if block:
+                block.append(line)
+            continue
+
+        if block:
+            entry = _parse_entry(block)
+            if entry is not None:
+                yield entry
+            block = []
+
+        if not line.strip() or line[0] in ';#%*':
+            continue
+
+        m = INCLUDE.match(line)
+        if m:
+            if includes is not None:
+                includes.append(m.group(1))
+        else:
+            block = [line]
+
+    if block:
+        entry = _parse_entry(block)
+        if entry is not None:
+            yield entry
+
+
+def read_journal(path: str, offset: int = 0) \
+        -> Tuple[List[JournalEntry], List[str], int]:
+    """Read the entries of a journal file from byte ``offset``.
+
+    Returns the entries, the absolute paths of included files and the
+    offset after the last complete line, so that a later call only reads
+    what has been appended since. Journals are expected to grow by whole
+    entries, as ``JournalWriter`` appends them.
+    """
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    end = data.rfind(b'\n') + 1
+    includes: List[str] = []
+    entries = list(parse_journal(
+        data[:end].decode('utf-8').splitlines(), includes))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    return (entries,
+            [os.path.join(directory, os.path.expanduser(i))
+             for i in includes],
+            offset + end)
+
+
+def add_monthly_balances(totals: Counter, entry: JournalEntry) -> None:
+    month = f'{entry.date.year:04d}-{entry.date.month:02d}'
+    for posting in entry.postings:
+        if posting:
+            name = getattr(posting.name, 'value', posting.name)
+            totals[(name, month)] += int(round(posting.value * 100))
+
+
+def monthly_balances(entries: Iterable[JournalEntry]) \
+        -> Dict[Tuple[str, str], int]:
+    """Cents posted per (account, 'YYYY-MM') by the entries."""
+
+    totals: Counter = Counter()
+    for entry in entries:
+        add_monthly_balances(totals, entry)
+    return dict(totals)
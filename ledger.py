@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+
+from array import array
+from datetime import date
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import click
+
+from journal import read_journal
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CACHE_VERSION = 1
+EPOCH = date(1970, 1, 1).toordinal()
+
+# Column name, array typecode: days since 1970, account ID and cents
+COLUMNS = [('dates', 'i'), ('accounts', 'i'), ('cents', 'q')]
+
+
+def _to_cents(value: Decimal) -> int:
+    return int(value.scaleb(2).to_integral_value())
+
+
+def _prefix_hash(path: str, offset: int) -> str:
+    # Hashing is much cheaper than parsing; it tells a journal that was
+    # only appended to from one that was edited
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while offset > 0:
+            block = f.read(min(offset, 1 << 20))
+            if not block:
+                break
+            h.update(block)
+            offset -= len(block)
+    return h.hexdigest()
+
+
+class ColumnCache:
+    """Postings of a single journal file in column files next to it.
+
+    The cache is kept in ``.<journal name>.cache``. It records the byte
+    offset up to which the journal was parsed; later updates only parse
+    what was appended since. The metadata is replaced atomically after the
+    columns are appended, so rows of an interrupted update are ignored.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.path.abspath(path)
+        directory, name = os.path.split(self.path)
+        self.directory = os.path.join(directory, f'.{name}.cache')
+        self.meta = self._empty_meta()
+
+    @staticmethod
+    def _empty_meta() -> Dict:
+        return {'version': CACHE_VERSION, 'offset': 0, 'rows': 0,
+                'prefix': None, 'size': None, 'mtime': None,
+                'accounts': [], 'includes': []}
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.directory, name + '.bin')
+
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, 'meta.json')
+
+    def _load_meta(self) -> None:
+        try:
+            with open(self._meta_path(), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+
+        stat = os.stat(self.path)
+        if meta is None or meta.get('version') != CACHE_VERSION:
+            valid = False
+        elif (stat.st_size, stat.st_mtime_ns) == \
+                (meta['size'], meta['mtime']):
+            valid = True
+        else:
+            valid = stat.st_size >= meta['offset'] and \
+                _prefix_hash(self.path, meta['offset']) == meta['prefix']
+        self.meta = meta if valid else self._empty_meta()
+
+    def _save_meta(self) -> None:
+        tmp = self._meta_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self._meta_path())
+
+    def update(self) -> int:
+        """Parse what was appended to the journal, return the new rows."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_meta()
+
+        stat = os.stat(self.path)
+        if (stat.st_size, stat.st_mtime_ns) == \
+                (self.meta['size'], self.meta['mtime']):
+            return 0
+
+        entries, includes, offset = read_journal(self.path,
+                                                 self.meta['offset'])
+
+        accounts = self.meta['accounts']
+        ids = {a: i for i, a in enumerate(accounts)}
+        columns = {name: array(code) for name, code in COLUMNS}
+
+        for entry in entries:
+            day = entry.date.toordinal() - EPOCH
+            for posting in entry.postings:
+                name = getattr(posting.name, 'value', posting.name)
+                if name not in ids:
+                    ids[name] = len(accounts)
+                    accounts.append(name)
+                columns['dates'].append(day)
+                columns['accounts'].append(ids[name])
+                columns['cents'].append(_to_cents(posting.value))
+
+        for name, code in COLUMNS:
+            with open(self._column_path(name), 'ab') as f:
+                # Drop rows of an update that never got its metadata saved
+                f.truncate(self.meta['rows'] * array(code).itemsize)
+                columns[name].tofile(f)
+
+        new_rows = len(columns['dates'])
+        self.meta.update(offset=offset, rows=self.meta['rows'] + new_rows,
+                         prefix=_prefix_hash(self.path, offset),
+                         size=stat.st_size, mtime=stat.st_mtime_ns,
+                         includes=self.meta['includes'] + includes)
+        self._save_meta()
+        return new_rows
+
+    def columns(self) -> Dict[str, Sequence[int]]:
+        rows = self.meta['rows']
+        result = {}
+        for name, code in COLUMNS:
+            with open(self._column_path(name), 'rb') as f:
+                if np is not None:
+                    result[name] = np.fromfile(f, dtype=code, count=rows)
+                else:
+                    result[name] = array(code)
+                    result[name].fromfile(f, rows)
+        return result
+
+
+class Ledger:
+    """All postings of a journal and its includes, one column per field.
+
+    ``dates`` are days since 1970-01-01, ``accounts`` index into
+    ``account_names`` and ``cents`` are the posted amounts. The columns are
+    NumPy arrays when NumPy is available and ``array`` objects otherwise.
+    """
+
+    def __init__(self, account_names: List[str], dates: Sequence[int],
+                 accounts: Sequence[int], cents: Sequence[int]) -> None:
+        self.account_names = account_names
+        self.dates = dates
+        self.accounts = accounts
+        self.cents = cents
+
+    @classmethod
+    def load(cls, path: str) -> 'Ledger':
+        names: List[str] = []
+        ids: Dict[str, int] = {}
+        parts: Dict[str, List] = {name: [] for name, _ in COLUMNS}
+
+        pending, seen = [os.path.abspath(path)], set()
+        while pending:
+            journal = pending.pop(0)
+            if journal in seen:
+                continue
+            seen.add(journal)
+
+            cache = ColumnCache(journal)
+            cache.update()
+            columns = cache.columns()
+
+            # Account IDs are per file, map them onto the combined list
+            mapping = []
+            for name in cache.meta['accounts']:
+                if name not in ids:
+                    ids[name] = len(names)
+                    names.append(name)
+                mapping.append(ids[name])
+
+            parts['dates'].append(columns['dates'])
+            parts['cents'].append(columns['cents'])
+            if np is not None:
+                parts['accounts'].append(
+                    np.array(mapping, dtype='i')[columns['accounts']]
+                    if mapping else columns['accounts'])
+            else:
+                parts['accounts'].append(
+                    array('i', (mapping[i] for i in columns['accounts'])))
+
+            pending.extend(cache.meta['includes'])
+
+        if np is not None:
+            merged = {name: np.concatenate(parts[name]).astype(code)
+                      for name, code in COLUMNS}
+        else:
+            merged = {}
+            for name, code in COLUMNS:
+                merged[name] = array(code)
+                for part in parts[name]:
+                    merged[name].extend(part)
+
+        return cls(names, merged['dates'], merged['accounts'],
+                   merged['cents'])
+
+    def _selection(self, begin: Optional[date], end: Optional[date]):
+        lower = begin.toordinal() - EPOCH if begin else None
+        upper = end.toordinal() - EPOCH if end else None
+
+        if np is not None:
+            mask = np.ones(len(self.dates), dtype=bool)
+            if lower is not None:
+                mask &= self.dates >= lower
+            if upper is not None:
+                mask &= self.dates < upper
+            return mask
+
+        return [(lower is None or d >= lower) and (upper is None or d < upper)
+                for d in self.dates]
+
+    def _totals(self, begin: Optional[date], end: Optional[date]) \
+            -> List[int]:
+        selected = self._selection(begin, end)
+
+        if np is not None:
+            # Float weights are exact for totals below 2 ** 53 cents
+            totals = np.bincount(self.accounts[selected],
+                                 weights=self.cents[selected],
+                                 minlength=len(self.account_names))
+            return totals.round().astype('q').tolist()
+
+        totals = [0] * len(self.account_names)
+        for keep, account, cents in zip(selected, self.accounts, self.cents):
+            if keep:
+                totals[account] += cents
+        return totals
+
+    def balances(self, begin: Optional[date] = None,
+                 end: Optional[date] = None) -> Dict[str, Decimal]:
+        """Balance per account of the postings in [begin, end)."""
+
+        return {name: Decimal(total).scaleb(-2)
+                for name, total in zip(self.account_names,
+                                       self._totals(begin, end))}
+
+    def balance(self, account: str, begin: Optional[date] = None,
+                end: Optional[date] = None) -> Decimal:
+        """Balance of an account including its subaccounts."""
+
+        totals = self._totals(begin, end)
+        return Decimal(sum(totals[i] for i in self._matches(account))) \
+            .scaleb(-2)
+
+    def _matches(self, account: str) -> List[int]:
+        return [i for i, name in enumerate(self.account_names)
+                if name == account or name.startswith(account + ':')]
+
+    def monthly(self, account: str, begin: Optional[date] = None,
+                end: Optional[date] = None) \
+            -> Dict[Tuple[int, int], Decimal]:
+        """Change per (year, month) of an account and its subaccounts."""
+
+        ids = self._matches(account)
+        selected = self._selection(begin, end)
+        totals: Dict[Tuple[int, int], int] = {}
+
+        if np is not None:
+            selected &= np.isin(self.accounts, ids)
+            months = (self.dates[selected].astype('datetime64[D]')
+                      .astype('datetime64[M]').astype('q'))
+            unique, inverse = np.unique(months, return_inverse=True)
+            sums = np.bincount(inverse, weights=self.cents[selected])
+            for month, total in zip(unique.tolist(), sums.tolist()):
+                totals[(1970 + month // 12, month % 12 + 1)] = round(total)
+        else:
+            ids = set(ids)
+            for keep, day, account_id, cents in zip(
+                    selected, self.dates, self.accounts, self.cents):
+                if keep and account_id in ids:
+                    d = date.fromordinal(day + EPOCH)
+                    key = (d.year, d.month)
+                    totals[key] = totals.get(key, 0) + cents
+
+        return {key: Decimal(total).scaleb(-2)
+                for key, total in sorted(totals.items())}
+
+
+@click.command()
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+@click.option('--account', '-a', help='Only this account and its '
+                                      'subaccounts, per month')
+@click.option('--begin', '-b', type=click.DateTime(['%Y-%m-%d']),
+              help='First date included')
+@click.option('--end', '-e', type=click.DateTime(['%Y-%m-%d']),
+              help='First date excluded')
+def main(journal, account, begin, end):
+    """Print account balances from the cached columns of a journal."""
+
+    ledger = Ledger.load(journal)
+    begin = begin.date() if begin else None
+    end = end.date() if end else None
+
+    if account:
+        for (year, month), value in \
+                ledger.monthly(account, begin, end).items():
+            click.echo(f'{year}-{month:02d}  €{value:>12.2f}')
+        total = ledger.balance(account, begin, end)
+        click.echo(f"{'total':<7s}  €{total:>12.2f}")
+        return
+
+    for name, value in sorted(ledger.balances(begin, end).items()):
+        if value:
+            click.echo(f'{name:<38s}  €{value:.2f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,255 @@
 import os
-import csv
-import click
 import re
+import sys
+import click
+import heapq
 import textwrap
+import time
 
-from dateutil.parser import parse as parse_date
+from collections import Counter
 from datetime import date, datetime as dt
-from typing import TextIO
+from decimal import Decimal
+from functools import partial
+from itertools import islice
+from operator import itemgetter
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, TextIO, Tuple)
 from enum import Enum
 
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import FuzzyWordCompleter
-from prompt_toolkit.validation import Validator
-from prompt_toolkit.styles import Style
+from journal import (Durability, open_writer, read_journal, writer_kwargs,
+                     writer_options)
+from rules import ING_RULES, Classification, RuleSet
+from state import ReviewItem, StateStore, file_key
+from stats import NO_STATS, Stats, profile_options, profiling
+from suggest import Suggester, Suggestions
+from util import (ACCOUNTS, Account, AssetAccounts, Ingest, JournalEntry,
+                  prefetch, sorted_stream, transaction_fingerprint)
+
+RawEntry = Tuple[date, Decimal, str, str]
+NUMBERS = re.compile(r'\d+')
+
+# A row of ``classify_file``, ``new`` unless imported by position before
+ClassifiedRow = Tuple[date, bool, bytes, Decimal, str, str,
+                      Optional[Enum], bool, bool, Optional[Suggestions]]
+
+# A new row with its rule classification and suggestions
+NewRow = Tuple[Optional[int], bytes, RawEntry]
+Classified = Tuple[NewRow, Optional[Classification], Optional[Suggestions]]
+
+
+def read_rows(input_csv: TextIO, stats: Stats = NO_STATS) \
+        -> Iterator[RawEntry]:
+    """Parse the transactions of a payment account export."""
+
+    try:
+        ingest = Ingest(input_csv)
+    except ValueError as e:
+        raise click.ClickException(f'{input_csv.name}: {e}')
+    if ingest.schema.account is not AssetAccounts.BANK_PAYMENT_ACCOUNT:
+        raise click.ClickException(f'{input_csv.name}: {ingest.schema.name} '
+                                   f'exports cannot be imported')
+
+    yield from ingest.transactions(stats.iterate('read', ingest.rows()))
+
+
+def answer_key(name: str, comment: str, amount: Decimal) -> str:
+    """Key under which a manual classification is remembered.
+
+    Only the first line of the description is used, lowercased, with
+    numbers (dates, references, store numbers) masked.
+    """
+
+    description = '{} - {}'.format(name, comment).split('\n', 1)[0]
+    description = ' '.join(NUMBERS.sub('#', description.lower()).split())
+    return ('-' if amount < 0 else '+') + description
+
+
+def read_new_rows(input_csv: TextIO, scope: str, next_id: int,
+                  legacy_count: int, is_known: Callable[[bytes], bool],
+                  sort_buffer: int, stats: Stats = NO_STATS) \
+        -> Iterator[NewRow]:
+    """Yield the rows whose fingerprint is not in the index yet.
+
+    New rows are numbered from ``next_id`` in date order. The first
+    ``legacy_count`` rows were imported by position before the index
+    existed; they are yielded with ``None`` as ID so that only their
+    fingerprints get recorded.
+    """
+
+    # Process the entries ordened by date
+    rows = stats.iterate('sort', sorted_stream(
+        stats.iterate('parse', read_rows(input_csv, stats)),
+        key=itemgetter(0), buffer_size=sort_buffer))
+
+    occurrences: Counter = Counter()
+    last_date = None
+
+    for position, row in enumerate(rows):
+        if row[0] != last_date:
+            occurrences.clear()
+            last_date = row[0]
+
+        occurrence = occurrences[row]
+        occurrences[row] += 1
+        fingerprint = transaction_fingerprint(scope, *row, occurrence)
+
+        if position < legacy_count:
+            yield None, fingerprint, row
+        elif not is_known(fingerprint):
+            yield next_id, fingerprint, row
+            next_id += 1
+
+
+def classify_rows(rows: Iterable[NewRow], rules: RuleSet,
+                  suggester: Optional[Suggester] = None,
+                  stats: Optional[Stats] = None,
+                  chunk_size: int = 256) -> Iterator[Classified]:
+    """Classify rows by the rules, with suggestions for uncertain rows.
+
+    Rows are handled in chunks so that the suggester scores all uncertain
+    rows of a chunk at once. Rows without ID are not classified.
+    """
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        classifications = [
+            None if transaction_id is None else
+            rules.classify('{} - {}'.format(name, comment), amount, stats)
+            for transaction_id, _, (_, amount, name, comment) in chunk]
+        suggestions: List[Optional[Suggestions]] = [None] * len(chunk)
+
+        uncertain = [i for i, c in enumerate(classifications)
+                     if c is not None and (c.ask or c.unknown)]
+        if suggester is not None and uncertain:
+            predictions = suggester.predict_batch(
+                [('{} - {}'.format(chunk[i][2][2], chunk[i][2][3]),
+                  chunk[i][2][1]) for i in uncertain])
+            for i, prediction in zip(uncertain, predictions):
+                suggestions[i] = prediction
+
+        yield from zip(chunk, classifications, suggestions)
+
+
+def classify_file(filename: str, scope: str, legacy_count: int,
+                  state_path: str, sort_buffer: int, rules: RuleSet,
+                  suggester: Optional[Suggester], profile: bool) \
+        -> Tuple[List[ClassifiedRow], Stats]:
+    """Read and classify the new rows of a file in a worker process.
+
+    Rows are not numbered here: rows that other files have as well are
+    only dropped after merging, so IDs are given out then. The stats of
+    the worker are returned with the rows when ``profile`` is set.
+    """
+
+    state = StateStore.open_readonly(state_path)
+    stats = Stats(profile)
+    rows = []
+
+    with open(filename, 'r') as input_csv:
+        new_rows = stats.iterate('dedup', read_new_rows(
+            input_csv, scope, 0, legacy_count, state.has_fingerprint,
+            sort_buffer, stats))
+        for (transaction_id, fingerprint, (date, amount, name, comment)), \
+                classification, suggestions in \
+                stats.iterate('classify',
+                              classify_rows(new_rows, rules, suggester)):
+            account2, ask, unknown = classification[:3] \
+                if classification else (None, False, False)
+            rows.append((date, transaction_id is not None, fingerprint,
+                         amount, name, comment, account2, ask, unknown,
+                         suggestions))
+
+    state.close()
+    return rows, stats
+
+
+# A transaction to replay: its source, date, amount, description and the
+# account it had so far
+ReplayRow = Tuple[str, date, Decimal, str, Optional[str]]
+# Account, ask, unknown and rule name of a classification
+ReplayResult = Tuple[str, bool, bool, str]
+
+# Descriptions of entries written by the import, '<year>-<id> - <text>'
+IMPORTED = re.compile(r'\d{4}-\d+ - (.*)')
+
+
+def export_rows(filename: str, accepted: Dict[Tuple[str, Decimal], str]) \
+        -> Iterator[ReplayRow]:
+    """Rows of an export, with the account an earlier replay accepted."""
+
+    with open(filename, 'r') as input_csv:
+        for date, amount, name, comment in read_rows(input_csv):
+            description = '{} - {}'.format(name, comment)
+            yield (filename, date, amount, description,
+                   accepted.get((description, amount)))
+
+
+def journal_rows(filename: str) -> Iterator[ReplayRow]:
+    """Entries the import wrote to a journal and its includes."""
+
+    pending, done = [filename], set()
+    while pending:
+        path = pending.pop(0)
+        if file_key(path) in done:
+            continue
+        done.add(file_key(path))
+
+        entries, includes, _ = read_journal(path)
+        pending.extend(includes)
+
+        for entry in entries:
+            m = IMPORTED.match(entry.description)
+            if not m or len(entry.postings) != 2 or \
+                    entry.postings[0].name != \
+                    AssetAccounts.BANK_PAYMENT_ACCOUNT.value:
+                continue
+
+            bank, other = entry.postings
+            yield path, entry.date, bank.value, m.group(1), other.name
+
+
+def classify_batch(rules: RuleSet,
+                   items: Sequence[Tuple[str, Decimal]]) -> List[ReplayResult]:
+    return [(account.value, ask, unknown, rule.name)
+            for account, ask, unknown, rule in rules.classify_many(items)]
+
+
+def replay_rows(rows: Sequence[ReplayRow], rules: RuleSet,
+                jobs: Optional[int] = None,
+                chunk_size: int = 50000) -> List[ReplayResult]:
+    """Classify rows by the rules, in chunks over worker processes.
+
+    Within a chunk, rows that only differ in ways the rules cannot tell
+    apart are classified once (see ``RuleSet.classify_many``).
+    """
 
-from util import Account, AssetAccounts, ExpenseAccounts, MiscAccounts,
-    IncomeAccounts, JournalEntry
+    chunks = [[(row[3], row[2]) for row in rows[i:i + chunk_size]]
+              for i in range(0, len(rows), chunk_size)]
+
+    # Worker processes only pay off with more than one CPU to run them on
+    if (jobs or os.cpu_count() or 1) == 1 or len(chunks) < 2:
+        results = map(partial(classify_batch, rules), chunks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(partial(classify_batch, rules),
+                                        chunks))
+
+    return [result for chunk in results for result in chunk]
 
 
 class TrackingFile:
-    def __init__(self, import_filename):
+    def __init__(self, import_filename: str, state: StateStore) -> None:
         self.import_filename = import_filename
-        self.fn = '.import_csv_tracking'
-
-        if os.path.isfile(self.fn):
-            with open(self.fn, 'r') as f:
-                values = {s[0]: int(s[1])
-                          for s in (l.strip().split(':')
-                          for l in f)}
-                self._current_id = values[import_filename] \
-                    if import_filename in values else -1
-        else:
-            self._current_id = -1
-            with open(self.fn, 'w') as f:
-                f.write('{}:{}\n'.format(self.import_filename,
-                                         self._current_id))
+        self.state = state
+        self.key = state.key(import_filename)
+
+        self._current_id, self.indexed = \
+            state.get_tracking(self.key) or (-1, True)
 
     @property
     def current_id(self):
@@ -43,76 +258,244 @@ class TrackingFile:
     @current_id.setter
     def current_id(self, value):
         self._current_id = value
-        data = ""
-        with open(self.fn, 'r+') as f:
-            for line in f:
-                if line.startswith(self.import_filename):
-                    data += "{}:{}\n".format(self.import_filename, value)
-                else:
-                    data += line
-
-            f.seek(0)
-            f.truncate()
-            f.write(data)
-
-
-class CSVProcessor:
+        self.indexed = True
+        self.state.set_current_id(self.key, value)
 
-    def __init__(self, input_csv: TextIO, output_journal: TextIO) -> None:
-        self.input_csv = input_csv
+    @property
+    def legacy_count(self) -> int:
+        # Rows imported by position before fingerprints were recorded
+        return 0 if self.indexed else self._current_id + 1
+
+    def mark_indexed(self) -> None:
+        self.current_id = self._current_id
+
+
+def prompt(message, **kwargs) -> str:
+    # prompt_toolkit takes longer to import than the rest of the script,
+    # so it is only loaded once a question is actually asked
+    from prompt_toolkit import prompt as toolkit_prompt
+    return toolkit_prompt(message, **kwargs)
+
+
+class AccountPrompt:
+    """Completer, validator and style of the account question.
+
+    They are built once, on the first question; only the order of the
+    completions changes between questions.
+    """
+
+    def __init__(self) -> None:
+        from prompt_toolkit.completion import FuzzyWordCompleter
+        from prompt_toolkit.styles import Style
+        from prompt_toolkit.validation import Validator
+
+        self.words = list(ACCOUNTS)
+        self.completer = FuzzyWordCompleter(words=lambda: self.words)
+        self.validator = Validator.from_callable(
+            lambda e: not e.strip() or e in ACCOUNTS,
+            move_cursor_to_end=True,
+            error_message='Invalid account name')
+        self.style = Style.from_dict({
+            'text': 'ansiyellow',
+            'default': 'ansicyan',
+            'prompt_symbol': 'ansiwhite bold'
+        })
+
+    def ask(self, default: Enum, suggested: Sequence[str]) -> Optional[Enum]:
+        """Ask for an account, None keeps the default."""
+
+        # The suggestions are listed first
+        self.words = list(suggested) + [a for a in ACCOUNTS
+                                        if a not in suggested]
+
+        account_str = prompt(
+            [('class:text', 'Enter the account '),
+             ('class:other', '['),
+             ('class:default', default.value),
+             ('class:other', ']'),
+             ('class:prompt_symbol', ' > ')],
+            completer=self.completer,
+            validator=self.validator,
+            style=self.style,
+            validate_while_typing=False)
+
+        return ACCOUNTS[account_str] if account_str.strip() else None
+
+
+class JournalProcessor:
+
+    def __init__(self, output_journal: TextIO,
+                 rules: RuleSet = ING_RULES,
+                 state: Optional[StateStore] = None,
+                 commit_every: int = 100,
+                 commit_interval: float = 1.0,
+                 durability: Durability = Durability.FLUSH,
+                 partition_by_year: bool = False,
+                 batch: bool = False,
+                 answer_cache_size: int = 10000,
+                 answer_max_age: Optional[float] = 365 * 24 * 3600,
+                 suggest: bool = False,
+                 suggest_threshold: float = 0.95,
+                 train_journals: Sequence[str] = (),
+                 stats: Stats = NO_STATS) -> None:
         self.output_journal = output_journal
-        self.tracking_file = TrackingFile(input_csv.name)
-
-    def process(self):
-        reader = csv.DictReader(self.input_csv)
+        self.rules = rules
+        self.batch = batch
+        self.answer_cache_size = answer_cache_size
+        self.answer_max_age = answer_max_age
+        self.suggest_threshold = suggest_threshold
+        self.stats = stats
+        self.state = state or StateStore()
+        if answer_cache_size and answer_max_age is not None:
+            self.state.expire_answers(answer_max_age)
+        self.writer = open_writer(output_journal, self.state,
+                                  partition_by_year=partition_by_year,
+                                  commit_every=commit_every,
+                                  commit_interval=commit_interval,
+                                  durability=durability, stats=stats)
+
+        self.suggester: Optional[Suggester] = None
+        if suggest:
+            with stats.stage('train'):
+                self.suggester = Suggester.load(self.state)
+                if self.suggester.train([output_journal.name,
+                                         *train_journals], self.state):
+                    self.suggester.save(self.state)
 
-        now = dt.now().strftime("%Y-%m-%d %H:%m:%S")
-        if self.tracking_file.current_id == -1:
-            self.output_journal.write(
-                f"; journal created on {now} by CSV import script\n\n")
-        else:
-            self.output_journal.write(
-                f"; journal continued on {now} by CSV import script\n\n")
-
-        self.output_journal.flush()
-
-        raw_entries = []
-
-        for row in reader:
-            amount = float(row['Bedrag (EUR)']
-                           .replace('.', '').replace(',', '.'))
-            if row['Af Bij'] == 'Af':
-                amount *= -1
+        self.unknown_count = 0
+        self.queued_count = 0
+        self._account_prompt: Optional[AccountPrompt] = None
 
-            date = parse_date(row['Datum'])
-            raw_entries.append((date, amount,
-                                row['Naam / Omschrijving'],
-                                row['Mededelingen']))
+    @property
+    def account_prompt(self) -> AccountPrompt:
+        if self._account_prompt is None:
+            self._account_prompt = AccountPrompt()
+        return self._account_prompt
 
-        self.unknown_count = 0
-        transaction_id = self.tracking_file.current_id + 1
+    def write_header(self, action: str) -> None:
+        now = dt.now().strftime("%Y-%m-%d %H:%m:%S")
+        self.writer.write(
+            f"; journal {action} on {now} by CSV import script\n\n",
+            entry=False)
+
+    def write_transaction(self, tracking_file: TrackingFile,
+                          transaction_id: Optional[int], fingerprint: bytes,
+                          entry: Optional[JournalEntry],
+                          review: Optional[ReviewItem]) -> None:
+        callbacks = [partial(self.state.add_fingerprint, fingerprint)]
+        if transaction_id is not None:
+            callbacks.append(partial(setattr, tracking_file, 'current_id',
+                                     transaction_id))
+        if review:
+            callbacks.append(partial(self.state.queue_review, review))
+
+        # Entries are rendered together when the writer commits
+        self.writer.write(entry or '', *callbacks)
+
+    def resolve_transaction(self, amount: Decimal, name: str, comment: str,
+                            date: date, transaction_id: int, account2: Enum,
+                            ask: bool, unknown: bool, source: str) \
+            -> Tuple[Optional[JournalEntry], Optional[ReviewItem]]:
+        if not self.batch:
+            return self.review_transaction(
+                amount, name, comment, date, transaction_id, account2, ask,
+                unknown), None
 
-        # Process the entries ordened by date
-        for date, amount, name, comment in sorted(
-                raw_entries, key=lambda e: e[0])[
-                    transaction_id:]:
+        if ask or unknown:
+            self.queued_count += 1
+            return None, ReviewItem(
+                self.writer.key, source, transaction_id, date, amount, name,
+                comment, account2.value, ask, unknown)
 
-            entry = self.convert_transaction(amount, name, comment, date,
-                                             transaction_id)
-            self.output_journal.write(entry.journal_str)
-            self.output_journal.flush()
+        return self.build_entry(amount, name, comment, date, transaction_id,
+                                account2), None
 
-            self.tracking_file.current_id = transaction_id
-            transaction_id += 1
+    def recall_answer(self, amount: Decimal, name: str,
+                      comment: str) -> Optional[Enum]:
+        if not self.answer_cache_size:
+            return None
 
-        print("Amount unknown: {}".format(self.unknown_count))
+        account = self.state.get_answer(answer_key(name, comment, amount),
+                                        self.answer_max_age)
+        return ACCOUNTS.get(account)
 
-    def match(self, s, *args):
-        reg = re.compile('.*(' + '|'.join(args) + ').*', re.IGNORECASE)
-        return reg.match(s) is not None
+    def learn_answer(self, amount: Decimal, name: str, comment: str,
+                     account: Enum) -> None:
+        if self.answer_cache_size:
+            self.state.set_answer(answer_key(name, comment, amount),
+                                  account.value, self.answer_cache_size)
 
-    def convert_transaction(self, amount: float, name: str, comment: str,
+    @property
+    def rule_stats(self) -> Optional[Stats]:
+        return self.stats if self.stats.enabled else None
+
+    def classify_transaction(self, amount: Decimal, name: str,
+                             comment: str) -> Classification:
+        return self.settle_classification(
+            self.rules.classify('{} - {}'.format(name, comment), amount,
+                                self.rule_stats),
+            amount, name, comment)
+
+    def settle_classification(self, classification: Classification,
+                              amount: Decimal, name: str, comment: str,
+                              suggestions: Optional[Suggestions] = None) \
+            -> Classification:
+        """Answer the question of an uncertain classification if possible.
+
+        Remembered answers only replace questions; rules that are certain
+        may depend on more than the description (e.g. the amount). After
+        that, a confident suggestion settles an unknown account, or
+        confirms the account the rules asked about.
+        """
+
+        if not (classification.ask or classification.unknown):
+            return classification
+
+        account = self.recall_answer(amount, name, comment)
+        if account is not None:
+            return classification._replace(account=account, ask=False,
+                                           unknown=False)
+
+        if suggestions is None:
+            suggestions = self.suggest(amount, name, comment)
+        for suggested, probability in suggestions[:1]:
+            account = ACCOUNTS.get(suggested)
+            if account is not None and \
+                    probability >= self.suggest_threshold and \
+                    (classification.unknown or
+                     account is classification.account):
+                return classification._replace(account=account, ask=False,
+                                               unknown=False)
+
+        return classification
+
+    def suggest(self, amount: Decimal, name: str, comment: str,
+                k: int = 3) -> Suggestions:
+        if self.suggester is None:
+            return []
+        return self.suggester.predict('{} - {}'.format(name, comment),
+                                      amount, k)
+
+    def build_entry(self, amount: Decimal, name: str, comment: str,
+                    date: date, transaction_id: int,
+                    account2: Enum) -> JournalEntry:
+        return JournalEntry(date, '{}-{} - {} - {}'.format(
+            date.year, transaction_id, name, comment), [
+                Account(name=AssetAccounts.BANK_PAYMENT_ACCOUNT,
+                        value=amount),
+                Account(name=account2, value=-amount)])
+
+    def convert_transaction(self, amount: Decimal, name: str, comment: str,
                             date: date, transaction_id: int) -> JournalEntry:
+        account2, ask, unknown, _ = self.classify_transaction(
+            amount, name, comment)
+        return self.review_transaction(amount, name, comment, date,
+                                       transaction_id, account2, ask,
+                                       unknown)
+
+    def review_transaction(self, amount: Decimal, name: str, comment: str,
+                           date: date, transaction_id: int, account2: Enum,
+                           ask: bool, unknown: bool) -> JournalEntry:
 
         description = '{} - {}'.format(name, comment)
         full_trans_id = '{}-{}'.format(date.year, transaction_id)
@@ -135,179 +518,15 @@ class CSVProcessor:
 
         click.echo("\tDirection:    " + direction)
 
-        entry = JournalEntry(date, '{} - {}'.format(
-            full_trans_id, description))
         account1: Enum = AssetAccounts.BANK_PAYMENT_ACCOUNT
-
-        ask = False
-        unknown = False
-
-        food_keywords = [
-            'eten',
-            'gnocchi',
-            'pasta',
-            'wraps',
-            'thais',
-            'indiaas',
-            'roti',
-            'pizza',
-            'lasagne',
-            'stamppot',
-            'boerenkool',
-            'risotto',
-            'chinees',
-            'sushi',
-            'wok'
-        ]
-
-        if self.match(description, 'spaarrekening'):
-            account2: Enum = AssetAccounts.BANK_SAVINGS
-
-        # === Expenses
-        elif amount < 0:
-
-            if self.match(description,
-                          'Albert Heijn',
-                          'AH to Go',
-                          'AH togo',
-                          'AH Station',
-                          'Lidl',
-                          'Jumbo',
-                          'Dirk',
-                          'Spar sciencepark',
-                          'UvAScience',
-                          'Fuameh',
-                          'Smullers',
-                          'McDonald(?:\'|\s)?s',
-                          r'\bMcD\b',
-                          'Broodzaak',
-                          r"Julia'?s",
-                          'Thuisbezorgd',
-                          *food_keywords):
-                account2 = ExpenseAccounts.FOOD_AND_GROCERIES
-
-            elif self.match(description,
-                            'VERENIGING INFORMATIEWETENSCH.AMSTERDAM'):
-
-                account2 = ExpenseAccounts.FOOD_AND_GROCERIES
-                if not self.match(description, 'Afschrijving POS'):
-                    ask = True
-
-            elif self.match(description,
-                            'Maslow',
-                            'DE HEEREN VAN AEMS',
-                            'Gall & Gall',
-                            'Chupitos',
-                            'Jeda Horeca',  # De Gieter
-                            'HOTSHOTS',
-                            'Bier',
-                            'Wodka'):
-                account2 = ExpenseAccounts.ALCOHOL
-
-            elif self.match(description, 'Incasso Creditcard'):
-                account2 = MiscAccounts.TRANSFER
-
-            elif self.match(description, 'SIMYO'):
-                account2 = ExpenseAccounts.PHONE_SUBSCRIPTION
-
-            elif self.match(description, 'UNICEF'):
-                account2 = ExpenseAccounts.DONATIONS
-
-            elif self.match(description,
-                            r'\bNS\b',
-                            'OV-Chipkaart'):
-                account2 = ExpenseAccounts.PUBLIC_TRANSPORT
-
-            elif self.match(description, 'Transip'):
-                account2 = ExpenseAccounts.DOMAIN_NAME
-
-            elif self.match(description, 'De Key') \
-                    and self.match(description, 'huur'):
-                account2 = ExpenseAccounts.RENT
-
-            elif self.match(description, 'Zorgverzekering'):
-                account2 = ExpenseAccounts.HEALTH_INSURANCE
-
-            elif self.match(description, 'Verzekering', 'Verzekeraar'):
-                account2 = ExpenseAccounts.OTHER_INSURANCE
-
-            elif self.match(description, 'AEGON'):
-                account2 = ExpenseAccounts.LIABILITY_INSURANCE
-
-            elif self.match(description, 'Sportexpl.mij'):  # = USC
-                account2 = ExpenseAccounts.SPORT
-
-            elif self.match(description, 'Basic Kappers'):
-                account2 = ExpenseAccounts.HAIRDRESSER
-
-            elif self.match(description, 'Belastingdienst'):
-                account2 = ExpenseAccounts.TAX
-
-            elif self.match(description, 'Infomedics'):
-                account2 = ExpenseAccounts.DENTIST
-
-            elif self.match(description,
-                            r'H\s?&\s?M',
-                            r'van\s?Haren'):
-                account2 = ExpenseAccounts.CLOTHING
-
-            elif self.match(description, 'Universiteit van Amsterdam') and \
-                    abs(amount) >= 1900:
-                account2 = ExpenseAccounts.TUITION_FEES
-
-            elif self.match(description, 'Betaalverzoek'):
-                account2 = ExpenseAccounts.FOOD_AND_GROCERIES
-                ask = True
-
-            elif self.match(description,
-                            r'\bCafe\b',
-                            'bier'):
-                account2 = ExpenseAccounts.ALCOHOL
-                ask = True
-
-            else:
-                account2 = ExpenseAccounts.MISC
-                unknown = True
-
-        # === Income
-        else:
-            if self.match(description, 'ST.STUDIEBEGELEIDING LDN'):
-                account2 = IncomeAccounts.SALARY_SSL
-
-            elif self.match(description, 'HET ZWARTE FIETSENPLAN'):
-                account2 = IncomeAccounts.SALARY_HZFP
-
-            elif self.match(description,
-                            r'\bDUO\b',
-                            'Dienst Uitvoering Onderwijs',
-                            'Studiefinanciering'):
-                account2 = IncomeAccounts.STUDENT_GRANTS
-
-            elif self.match(description, 'Huurtoeslag'):
-                account2 = IncomeAccounts.RENT_ALLOWANCE
-
-            elif self.match(description, 'Zorgtoeslag'):
-                account2 = IncomeAccounts.HEALTH_ALLOWANCE
-
-            elif self.match(description, 'Universiteit van Amsterdam'):
-                account2 = IncomeAccounts.BOARD_GRANT
-
-                if amount != 275:
-                    ask = True
-
-            elif self.match(description, 'Betaalverzoek') and \
-                    self.match(description, *food_keywords):
-                account2 = ExpenseAccounts.FOOD_AND_GROCERIES
-
-            elif self.match(description, *food_keywords):
-                account2 = ExpenseAccounts.FOOD_AND_GROCERIES
-                ask = True
-
-            else:
-                account2 = IncomeAccounts.OTHER
-                unknown = True
+        tags = []
+        answered = False
 
         if ask or unknown:
+            # Everything before this transaction is committed while the user
+            # is looking at the prompt
+            self.writer.commit()
+
             click.echo("\n\tFull description:\n" + click.style("\t{}".format(
                 '\n\t'.join(textwrap.wrap(description))),
                 fg='blue', bold=True))
@@ -317,10 +536,15 @@ class CSVProcessor:
                                    fg='cyan', bold=True))
             click.echo(click.style("\t" + account2.value, fg='yellow'))
 
-            if not click.confirm('\n> ' + click.style(
+            with self.stats.stage('user'):
+                correct = click.confirm('\n> ' + click.style(
                     'Is this correct?', fg='magenta', bold=True),
-                    default=True):
+                    default=True)
+
+            if not correct:
                 unknown = True
+            else:
+                answered = True
 
         elif unknown:
             click.echo(click.style(
@@ -330,62 +554,40 @@ class CSVProcessor:
         if unknown:
             self.unknown_count += 1
 
+            suggested = [a for a, _ in self.suggest(amount, name, comment)
+                         if a in ACCOUNTS]
+            if suggested:
+                click.echo(click.style("\n\tSuggested accounts:",
+                                       fg='cyan', bold=True))
+                for account in suggested:
+                    click.echo(click.style("\t" + account, fg='yellow'))
+
             confirmed = False
             while not confirmed:
 
-                if click.confirm('\n> ' + click.style(
+                with self.stats.stage('user'):
+                    manual = click.confirm('\n> ' + click.style(
                         'Do you want to enter the account manually',
-                        fg='magenta', bold=True), default=True):
-
-                    all_accounts = [e.value for e in
-                                    list(AssetAccounts) +
-                                    list(ExpenseAccounts) +
-                                    list(IncomeAccounts) +
-                                    list(MiscAccounts)]
-
-                    accounts_dict = {e.value: e for e in
-                                    list(AssetAccounts) +
-                                    list(ExpenseAccounts) +
-                                    list(IncomeAccounts) +
-                                    list(MiscAccounts)]
-
-                    completer = FuzzyWordCompleter(words=all_accounts)
-
-                    validator = Validator.from_callable(
-                        lambda e: not e.strip() or e in accounts_dict,
-                        move_cursor_to_end=True,
-                        error_message='Invalid account name')
-
-                    style = Style.from_dict({
-                        'text': 'ansiyellow',
-                        'default': 'ansicyan',
-                        'prompt_symbol': 'ansiwhite bold'
-                    })
+                        fg='magenta', bold=True), default=True)
 
+                if manual:
                     try:
-                        account_str = prompt(
-                            [('class:text', 'Enter the account '),
-                             ('class:other', '['),
-                             ('class:default', account2.value),
-                             ('class:other', ']'),
-                             ('class:prompt_symbol', ' > ')],
-                            completer=completer,
-                            validator=validator,
-                            style=style,
-                            validate_while_typing=False)
-
+                        with self.stats.stage('user'):
+                            account = self.account_prompt.ask(account2,
+                                                              suggested)
                     except KeyboardInterrupt:
                         continue
 
-                    if account_str.strip():
-                        account2 = accounts_dict[account_str]
+                    if account is not None:
+                        account2 = account
 
+                    answered = True
                     break
                 else:
                     click.echo(click.style(
                         'Marking the transaction with tag UNKNOWN_TRANSACTION',
                         fg='cyan', bold=True))
-                    entry.tags.append('UNKNOWN_TRANSACTION')
+                    tags.append('UNKNOWN_TRANSACTION')
                     break
 
             arrow = '-->' if amount < 0 else '<--'
@@ -403,22 +605,438 @@ class CSVProcessor:
 
         print()
 
-        entry.account1 = Account(name=account1, value=amount)
-        entry.account2 = Account(name=account2, value=-amount)
+        if answered:
+            self.learn_answer(amount, name, comment, account2)
 
+        entry = self.build_entry(amount, name, comment, date, transaction_id,
+                                 account2)
+        entry.tags.extend(tags)
         return entry
 
 
-@click.command()
+class CSVProcessor(JournalProcessor):
+
+    def __init__(self, input_csv: TextIO, output_journal: TextIO,
+                 sort_buffer: int = 100000, look_ahead: int = 0,
+                 **kwargs) -> None:
+        super().__init__(output_journal, **kwargs)
+        self.input_csv = input_csv
+        self.sort_buffer = sort_buffer
+        self.look_ahead = look_ahead
+        self.tracking_file = TrackingFile(input_csv.name, self.state)
+
+    def process(self):
+        with self.writer:
+            if self.tracking_file.current_id == -1:
+                self.write_header('created')
+            else:
+                self.write_header('continued')
+
+            next_id = self.tracking_file.current_id + 1
+            legacy_count = self.tracking_file.legacy_count
+
+            # Stats of the background thread, merged once it is done
+            ahead_stats = None
+            if self.look_ahead and not self.batch:
+                ahead_stats = Stats(self.stats.enabled)
+                # Time the rows were not classified ahead yet
+                classified = self.stats.iterate('wait', prefetch(
+                    self.classify_ahead(next_id, legacy_count, ahead_stats),
+                    self.look_ahead))
+            else:
+                classified = classify_rows(
+                    self.stats.iterate('dedup', read_new_rows(
+                        self.input_csv, self.writer.key, next_id,
+                        legacy_count, self.state.has_fingerprint,
+                        self.sort_buffer, self.stats)),
+                    self.rules, self.suggester, self.rule_stats)
+
+            for transaction_id, fingerprint, entry, review in \
+                    self.stats.iterate('classify',
+                                       self.classify(classified)):
+                self.write_transaction(self.tracking_file, transaction_id,
+                                       fingerprint, entry, review)
+            if ahead_stats is not None:
+                self.stats.merge(ahead_stats)
+
+            if not self.tracking_file.indexed:
+                self.writer.write('', self.tracking_file.mark_indexed,
+                                  entry=False)
+
+        self.print_summary()
+
+    def print_summary(self):
+        print("Amount unknown: {}".format(self.unknown_count))
+        if self.batch:
+            print("Queued for review: {}".format(self.queued_count))
+
+    def classify_ahead(self, next_id: int, legacy_count: int,
+                       stats: Stats = NO_STATS) -> Iterator[Classified]:
+        """Read, deduplicate and classify by the rules on another thread.
+
+        Everything that depends on earlier answers, i.e. remembered
+        answers, questions and writes, stays on the main thread. ``stats``
+        is only used by the other thread.
+        """
+
+        # SQLite connections cannot be shared between threads; rows written
+        # meanwhile have other fingerprints, so a snapshot is good enough
+        state = StateStore.open_readonly(self.state.path)
+        try:
+            yield from stats.iterate('classify', classify_rows(
+                stats.iterate('dedup', read_new_rows(
+                    self.input_csv, self.writer.key, next_id, legacy_count,
+                    state.has_fingerprint, self.sort_buffer, stats)),
+                self.rules, self.suggester,
+                stats if stats.enabled else None))
+        finally:
+            state.close()
+
+    def classify(self, classified: Iterable[Classified]) \
+            -> Iterator[Tuple[Optional[int], bytes, Optional[JournalEntry],
+                              Optional[ReviewItem]]]:
+        for (transaction_id, fingerprint, (date, amount, name, comment)), \
+                classification, suggestions in classified:
+            if transaction_id is None:
+                yield transaction_id, fingerprint, None, None
+                continue
+
+            account2, ask, unknown, _ = self.settle_classification(
+                classification, amount, name, comment, suggestions)
+
+            yield (transaction_id, fingerprint, *self.resolve_transaction(
+                amount, name, comment, date, transaction_id, account2, ask,
+                unknown, self.tracking_file.key))
+
+
+class MultiCSVProcessor(CSVProcessor):
+    """Imports several CSV files into one journal.
+
+    Files are parsed and classified in parallel worker processes. The
+    results are merged by date, then by position on the command line, and
+    everything that needs the user or the journal happens in this process
+    in that order, so the output does not depend on the number of jobs.
+    """
+
+    def __init__(self, input_csvs: List[str], output_journal: TextIO,
+                 jobs: Optional[int] = None, sort_buffer: int = 100000,
+                 **kwargs) -> None:
+        JournalProcessor.__init__(self, output_journal, **kwargs)
+        self.input_csvs = input_csvs
+        self.jobs = jobs
+        self.sort_buffer = sort_buffer
+        self.tracking_files = [TrackingFile(fn, self.state)
+                               for fn in input_csvs]
+
+    def process(self):
+        tasks = [(t.import_filename, self.writer.key, t.legacy_count,
+                  self.state.path, self.sort_buffer, self.rules,
+                  self.suggester, self.stats.enabled)
+                 for t in self.tracking_files]
+
+        with self.stats.stage('workers'):
+            if self.jobs == 1:
+                results = list(map(classify_file, *zip(*tasks)))
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(self.jobs) as executor:
+                    results = list(executor.map(classify_file,
+                                                *zip(*tasks)))
+
+        # Stages of the workers, which ran within the workers stage
+        for _, stats in results:
+            self.stats.merge(stats)
+
+        def keyed(index, rows):
+            return (((row[0], index), row) for row in rows)
+
+        merged = heapq.merge(
+            *(keyed(index, rows)
+              for index, (rows, _) in enumerate(results)),
+            key=itemgetter(0))
+
+        with self.writer:
+            if all(t.current_id == -1 for t in self.tracking_files):
+                self.write_header('created')
+            else:
+                self.write_header('continued')
+
+            # Exports that overlap each other are only deduplicated here,
+            # then the rows left are numbered as a run per file would
+            seen = set()
+            next_ids = [t.current_id + 1 for t in self.tracking_files]
+
+            for (_, index), (date, new, fingerprint, amount, name, comment,
+                             account2, ask, unknown, suggestions) in merged:
+                tracking_file = self.tracking_files[index]
+                if fingerprint in seen:
+                    continue
+                seen.add(fingerprint)
+
+                entry = review = transaction_id = None
+                if new:
+                    transaction_id = next_ids[index]
+                    next_ids[index] += 1
+
+                    with self.stats.stage('classify'):
+                        account2, ask, unknown, _ = \
+                            self.settle_classification(
+                                Classification(account2, ask, unknown, None),
+                                amount, name, comment, suggestions)
+
+                        entry, review = self.resolve_transaction(
+                            amount, name, comment, date, transaction_id,
+                            account2, ask, unknown, tracking_file.key)
+
+                self.write_transaction(tracking_file, transaction_id,
+                                       fingerprint, entry, review)
+
+            for tracking_file in self.tracking_files:
+                if not tracking_file.indexed:
+                    self.writer.write('', tracking_file.mark_indexed,
+                                      entry=False)
+
+        self.print_summary()
+
+
+class ReviewProcessor(JournalProcessor):
+
+    def process(self):
+        items = self.state.review_queue(self.writer.key)
+
+        with self.writer:
+            if items:
+                self.write_header('continued')
+
+            for item in items:
+                with self.stats.stage('classify'):
+                    # Possibly answered for an earlier item in the queue
+                    account2, ask, unknown, _ = self.settle_classification(
+                        Classification(ACCOUNTS[item.account], item.ask,
+                                       item.unknown, None),
+                        item.amount, item.name, item.comment)
+
+                    entry = self.review_transaction(
+                        item.amount, item.name, item.comment, item.date,
+                        item.transaction_id, account2, ask, unknown)
+
+                self.writer.write(entry,
+                                  partial(self.state.remove_review, item))
+
+        print("Reviewed: {}".format(len(items)))
+        print("Amount unknown: {}".format(self.unknown_count))
+
+
+def journal_options(f):
+    f = writer_options(f)
+    for option in reversed([
+        click.option('--answer-cache-size', default=10000,
+                     show_default=True, type=click.IntRange(min=0),
+                     help='Number of manual classifications remembered, '
+                          '0 disables remembering them'),
+        click.option('--answer-max-age', default=365, show_default=True,
+                     type=click.IntRange(min=1),
+                     help='Days after which a remembered classification '
+                          'is asked again'),
+        click.option('--suggest/--no-suggest', default=True,
+                     show_default=True,
+                     help='Suggest accounts learned from the journals for '
+                          'transactions the rules do not know'),
+        click.option('--suggest-threshold', default=0.95, show_default=True,
+                     type=click.FloatRange(0, 1),
+                     help='Probability from which a suggestion is applied '
+                          'without asking'),
+        click.option('--train-journal', 'train_journals', multiple=True,
+                     type=click.Path(exists=True, dir_okay=False),
+                     help='Journal to learn suggestions from besides the '
+                          'output journal, can be given multiple times'),
+    ]):
+        f = option(f)
+    return profile_options(f)
+
+
+def journal_kwargs(commit_every, commit_interval, durability,
+                   partition_by_year, answer_cache_size, answer_max_age,
+                   suggest, suggest_threshold, train_journals):
+    return dict(**writer_kwargs(commit_every, commit_interval, durability,
+                                partition_by_year),
+                answer_cache_size=answer_cache_size,
+                answer_max_age=answer_max_age * 24 * 3600,
+                suggest=suggest,
+                suggest_threshold=suggest_threshold,
+                train_journals=train_journals)
+
+
+class DefaultGroup(click.Group):
+    """Command group that runs ``import`` when no command is given.
+
+    This keeps ``process_ing.py -i export.csv -o journal`` working as
+    before the other commands were added.
+    """
+
+    def parse_args(self, ctx: click.Context, args: List[str]) -> List[str]:
+        if args and args[0] not in self.commands and args[0] != '--help':
+            args = ['import'] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup)
+def cli():
+    """Import ING exports into a journal, ``import`` is the default."""
+
+
+@cli.command('import')
 @click.option('--input-csv', '-i', required=True, type=click.File(mode='r'),
               help='Input CSV file')
-@click.option('--output-journal', '-o', required=True,
-              type=click.File(mode='a+'), help='Output hledger journal file')
-def main(input_csv, output_journal):
-
-    p = CSVProcessor(input_csv, output_journal)
-    p.process()
+@journal_options
+@click.option('--batch', is_flag=True,
+              help='Never prompt, queue uncertain transactions for review')
+@click.option('--sort-buffer', default=100000, show_default=True,
+              type=click.IntRange(min=1),
+              help='Maximum number of rows sorted in memory, larger '
+                   'exports are sorted on disk')
+@click.option('--look-ahead', default=1000, show_default=True,
+              type=click.IntRange(min=0),
+              help='Number of rows classified on a background thread '
+                   'while a question is open, 0 disables it')
+def main(input_csv, output_journal, batch, sort_buffer, look_ahead, profile,
+         profile_json, **kwargs):
+
+    with profiling(profile, profile_json, ING_RULES.rules) as stats:
+        p = CSVProcessor(input_csv, output_journal, batch=batch,
+                         sort_buffer=sort_buffer, look_ahead=look_ahead,
+                         stats=stats, **journal_kwargs(**kwargs))
+        p.process()
+
+
+@cli.command('import-many')
+@click.option('--input-csv', '-i', 'input_csvs', required=True,
+              multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help='Input CSV file, can be given multiple times')
+@journal_options
+@click.option('--batch', is_flag=True,
+              help='Never prompt, queue uncertain transactions for review')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='Number of worker processes  [default: CPU count]')
+@click.option('--sort-buffer', default=100000, show_default=True,
+              type=click.IntRange(min=1),
+              help='Maximum number of rows sorted in memory per file, '
+                   'larger exports are sorted on disk')
+def import_many(input_csvs, output_journal, batch, jobs, sort_buffer,
+                profile, profile_json, **kwargs):
+    """Import several CSV files into one journal."""
+
+    if len({file_key(fn) for fn in input_csvs}) != len(input_csvs):
+        raise click.BadParameter('the same file is given more than once',
+                                 param_hint="'--input-csv'")
+
+    # Rules run in the worker processes and are not counted there
+    with profiling(profile, profile_json) as stats:
+        p = MultiCSVProcessor(list(input_csvs), output_journal, jobs=jobs,
+                              batch=batch, sort_buffer=sort_buffer,
+                              stats=stats, **journal_kwargs(**kwargs))
+        p.process()
+
+
+@cli.command()
+@journal_options
+def review(output_journal, profile, profile_json, **kwargs):
+    """Review the transactions queued by a batch import."""
+
+    with profiling(profile, profile_json) as stats:
+        p = ReviewProcessor(output_journal, stats=stats,
+                            **journal_kwargs(**kwargs))
+        p.process()
+
+
+@cli.command()
+@click.option('--input-csv', '-i', 'input_csvs', multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='CSV export to replay, can be given multiple times')
+@click.option('--journal', 'journals', multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='Journal whose imported entries are replayed, with its '
+                   'includes, can be given multiple times')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='Number of worker processes  [default: CPU count]')
+@click.option('--show', default=20, show_default=True,
+              type=click.IntRange(min=0),
+              help='Number of changed transactions listed')
+@click.option('--accept', is_flag=True,
+              help='Keep the accounts of the CSV exports as the reference '
+                   'for the next replay')
+@profile_options
+def replay(input_csvs, journals, jobs, show, accept, profile, profile_json):
+    """Run past transactions through the rules without asking anything.
+
+    Transactions of journals are compared with the account they were
+    booked on, those of CSV exports with the account accepted by an
+    earlier replay. Transactions the rules ask about or do not know are
+    counted, not compared, as their account was given by hand. Exits
+    with status 1 when an account changed.
+    """
+
+    if not input_csvs and not journals:
+        raise click.UsageError('Give at least one --input-csv or --journal')
+
+    with profiling(profile, profile_json) as stats:
+        start = time.perf_counter()
+        state = StateStore()
+        with stats.stage('parse'):
+            accepted = state.replays() if input_csvs else {}
+            rows: List[ReplayRow] = [
+                row for filename in input_csvs
+                for row in export_rows(filename, accepted)]
+            exported = len(rows)
+            rows.extend(row for filename in journals
+                        for row in journal_rows(filename))
+
+        with stats.stage('classify'):
+            results = replay_rows(rows, ING_RULES, jobs)
+        seconds = time.perf_counter() - start
+
+        with stats.stage('report'):
+            changed = []
+            transitions: Counter = Counter()
+            new = asked = unknown = 0
+            for row, (account, ask, is_unknown, rule) in zip(rows, results):
+                if is_unknown:
+                    unknown += 1
+                elif ask:
+                    asked += 1
+                elif row[4] is None:
+                    new += 1
+                elif row[4] != account:
+                    changed.append((row, account, rule))
+                    transitions[(row[4], account)] += 1
+
+            for (source, date, amount, description, old), account, rule \
+                    in changed[:show]:
+                click.echo(f'{date:%Y-%m-%d} {amount:>10.2f}  '
+                           f'{textwrap.shorten(description, 40)}')
+                click.echo(f'    {old} -> {account}  ({rule}, {source})')
+            if changed[show:]:
+                click.echo(f'... and {len(changed) - show} more')
+            if changed:
+                click.echo()
+            for (old, account), count in transitions.most_common():
+                click.echo(f'{count:>8d}  {old} -> {account}')
+
+            if accept:
+                state.set_replays(
+                    ((row[3], row[2]), account)
+                    for row, (account, ask, is_unknown, _)
+                    in zip(rows[:exported], results)
+                    if not (ask or is_unknown))
+        state.close()
+
+    click.echo(f'Replayed: {len(rows)} in {seconds:.2f}s '
+               f'({len(rows) / max(seconds, 1e-9):,.0f} rows/s)')
+    click.echo(f'Changed: {len(changed)}' +
+               (', accepted' if accept and changed else ''))
+    click.echo(f'Asked: {asked}, unknown: {unknown}, new: {new}')
+    sys.exit(1 if changed and not accept else 0)
 
 
 if __name__ == "__main__":
-    main()
+    cli()
@@ -1,30 +1,135 @@
 import csv
 import click
+import glob
+import os
+
+from typing import Dict, Iterator, TextIO
+
+from util import ColumnBatch, Ingest
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def read_chunks(input_csv: TextIO, chunk_size: int) -> Iterator[ColumnBatch]:
+    try:
+        ingest = Ingest(input_csv)
+        yield from ingest.batches(chunk_size)
+    except ValueError as e:
+        raise click.ClickException(f'{input_csv.name}: {e}')
+
+
+class CSVOutput:
+    """The original date,description,amount CSV."""
+
+    def __init__(self, path: str, append: bool) -> None:
+        exists = append and os.path.exists(path) and os.path.getsize(path)
+        self.f = open(path, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.f, lineterminator='\r\n')
+        if not exists:
+            self.writer.writerow(['date', 'description', 'amount'])
+
+    def write(self, chunk: ColumnBatch) -> None:
+        self.writer.writerows(
+            (f'{date:%Y%m%d}', '{} - {}'.format(name, comment), amount)
+            for date, amount, name, comment in chunk.transactions())
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class ColumnarOutput:
+    """A dataset directory of Parquet or Arrow IPC files.
+
+    Every run writes one part file with a ``date`` (date32), a
+    ``description`` (string) and a ``cents`` (int64) column, one record
+    batch or row group per chunk. Appending adds a part file; otherwise
+    the existing parts are replaced.
+    """
+
+    def __init__(self, path: str, fmt: str, append: bool) -> None:
+        if pa is None:
+            raise click.UsageError(f'--format {fmt} requires pyarrow')
+
+        self.schema = pa.schema([('date', pa.date32()),
+                                 ('description', pa.string()),
+                                 ('cents', pa.int64())])
+        extension = EXTENSIONS[fmt]
+
+        os.makedirs(path, exist_ok=True)
+        parts = sorted(glob.glob(os.path.join(path, f'part-*.{extension}')))
+        if not append:
+            for part in parts:
+                os.remove(part)
+            parts = []
+
+        number = int(os.path.basename(parts[-1]).split('.')[0][5:]) + 1 \
+            if parts else 0
+        self.part = os.path.join(path, f'part-{number:05d}.{extension}')
+
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(self.part, self.schema)
+        else:
+            self.sink = pa.OSFile(self.part, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+
+    def write(self, chunk: ColumnBatch) -> None:
+        descriptions = ['{} - {}'.format(name, comment) for name, comment
+                        in zip(chunk.counterparties, chunk.descriptions)]
+        batch = pa.RecordBatch.from_arrays([
+            pa.array(chunk.dates, type=pa.date32()),
+            pa.array(descriptions, type=pa.string()),
+            pa.array(chunk.cents, type=pa.int64()),
+        ], schema=self.schema)
+        if isinstance(self.writer, pq.ParquetWriter):
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self) -> None:
+        self.writer.close()
+        if hasattr(self, 'sink'):
+            self.sink.close()
+
+
+def default_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    formats: Dict[str, str] = {'parquet': 'parquet', 'arrow': 'arrow',
+                               'feather': 'arrow', 'ipc': 'arrow'}
+    return formats.get(extension, 'csv')
 
 
 @click.command()
 @click.option('--input-csv', '-i', required=True, type=click.File(mode='r'),
               help='Input CSV file')
-@click.option('--output-csv', '-o', required=True, type=click.File(mode='w'),
-              help='Output CSV file')
-def main(input_csv, output_csv):
-    reader = csv.DictReader(input_csv)
-    writer = csv.DictWriter(output_csv, ['date', 'description', 'amount'])
-
-    writer.writeheader()
-
-    for row in reader:
-        amount = float(row['Bedrag (EUR)'].replace('.', '').replace(',', '.'))
-        if row['Af Bij'] == 'Af':
-            amount *= -1
-
-        description = '{} - {}'.format(row['Naam / Omschrijving'],
-                                       row['Mededelingen'])
-        date = row['Datum']
-
-        writer.writerow({'date': date,
-                         'description': description,
-                         'amount': amount})
+@click.option('--output', '-o', '--output-csv', 'output', required=True,
+              type=click.Path(), help='Output CSV file, or dataset '
+                                      'directory for parquet and arrow')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'parquet',
+                                                   'arrow']),
+              help='Output format  [default: from the output extension, '
+                   'else csv]')
+@click.option('--append', is_flag=True,
+              help='Add to the existing output instead of replacing it')
+@click.option('--chunk-size', default=65536, show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of rows converted at once')
+def main(input_csv, output, fmt, append, chunk_size):
+    fmt = fmt or default_format(output)
+    writer = CSVOutput(output, append) if fmt == 'csv' else \
+        ColumnarOutput(output, fmt, append)
+
+    try:
+        for chunk in read_chunks(input_csv, chunk_size):
+            writer.write(chunk)
+    finally:
+        writer.close()
+
 
 if __name__ == "__main__":
     main()
@@ -1,68 +1,320 @@
 import click
-import csv
-from datetime import datetime as dt
-from dateutil.parser import parse as parse_date
+import re
 
-from typing import TextIO
+from datetime import date, datetime as dt
+from decimal import Decimal
+from enum import Enum
 
-from util import Account, AssetAccounts, IncomeAccounts, JournalEntry
+from functools import partial
+from typing import Dict, List, Optional, Sequence, TextIO, Tuple, Union
+
+from journal import (Durability, open_writer, read_journal, writer_kwargs,
+                     writer_options)
+from state import StateStore
+from stats import NO_STATS, Stats, profile_options, profiling
+from util import (Account, AssetAccounts, IncomeAccounts, Ingest,
+                  JournalEntry)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Value column of the original single fund export
+DEFAULT_FUND = 'Value'
+
+# Dates and values in cents of a fund, NumPy arrays when available
+Series = Tuple[Sequence, Sequence[int]]
+
+# Date, fund, change and new value in cents
+ValueUpdate = Tuple[date, str, int, int]
+
+# Descriptions of the entries written by ``CSVProcessor.value_update``
+VALUE_UPDATE = re.compile(r'\d{4}-M-(\d+) - Meesman(?: (.+?))? value update')
+
+
+def fund_accounts(fund: str) -> Tuple[Union[Enum, str], Union[Enum, str]]:
+    if fund == DEFAULT_FUND:
+        return (AssetAccounts.INVESTMENT_FUND,
+                IncomeAccounts.INVESTMENT_FUND_RETURN)
+    return (f'{AssetAccounts.INVESTMENT_FUND.value}:{fund}',
+            f'{IncomeAccounts.INVESTMENT_FUND_RETURN.value}:{fund}')
+
+
+def to_date(value) -> date:
+    return value.astype(object) if np is not None else value
+
+
+def sort_series(dates: Sequence, cents: Sequence[int], fund: str) -> Series:
+    """Sort a series by date, dropping dates that occur more than once
+    with the same value."""
+
+    if np is not None:
+        order = np.argsort(dates, kind='stable')
+        dates, cents = dates[order], cents[order]
+        repeated = np.flatnonzero(dates[1:] == dates[:-1]) + 1
+        if (cents[repeated] != cents[repeated - 1]).any():
+            raise click.ClickException(
+                f'Conflicting values for fund {fund!r}')
+        keep = np.ones(len(dates), dtype=bool)
+        keep[repeated] = False
+        return dates[keep], cents[keep]
+
+    pairs = sorted(zip(dates, cents), key=lambda p: p[0])
+    unique: Dict[date, int] = {}
+    for d, c in pairs:
+        if unique.setdefault(d, c) != c:
+            raise click.ClickException(
+                f'Conflicting values for fund {fund!r}')
+    return list(unique), list(unique.values())
+
+
+def value_on(series: Series, value_date: date) -> Optional[int]:
+    """Value in cents of a sorted series on a date, if it has one."""
+
+    dates, cents = series
+    if np is not None:
+        index = np.searchsorted(dates, np.datetime64(value_date, 'D'))
+        if index < len(dates) and dates[index] == \
+                np.datetime64(value_date, 'D'):
+            return int(cents[index])
+        return None
+
+    for d, c in zip(dates, cents):
+        if d == value_date:
+            return c
+    return None
+
+
+def imported_updates(path: str) -> Tuple[int, Dict[str, date]]:
+    """Highest transaction ID and last date per fund of the value updates
+    in a journal and its includes."""
+
+    last_id, last_dates = -1, {}  # type: int, Dict[str, date]
+    pending, done = [path], set()
+    while pending:
+        path = pending.pop(0)
+        if path in done:
+            continue
+        done.add(path)
+
+        entries, includes, _ = read_journal(path)
+        pending.extend(includes)
+
+        for entry in entries:
+            m = VALUE_UPDATE.match(entry.description)
+            if not m:
+                continue
+            fund = m.group(2) or DEFAULT_FUND
+            last_id = max(last_id, int(m.group(1)))
+            if fund not in last_dates or entry.date > last_dates[fund]:
+                last_dates[fund] = entry.date
+    return last_id, last_dates
+
+
+def value_changes(series: Series, last: Optional[Tuple[date, int]]) \
+        -> Tuple[List[date], List[int], List[int]]:
+    """Changes of a sorted series after the last imported value.
+
+    Without a last value, the first value of the series is the starting
+    point. Returns the dates, changes and values of the updates.
+    """
+
+    dates, cents = series
+    if np is not None:
+        if last is not None:
+            new = dates > np.datetime64(last[0], 'D')
+            dates, cents = dates[new], cents[new]
+            previous = last[1]
+        elif len(cents):
+            dates, cents, previous = dates[1:], cents[1:], cents[0]
+        else:
+            return [], [], []
+
+        changes = np.diff(cents, prepend=previous)
+        return dates.astype(object).tolist(), changes.tolist(), cents.tolist()
+
+    if last is not None:
+        pairs = [(d, c) for d, c in zip(dates, cents) if d > last[0]]
+        previous = last[1]
+    elif cents:
+        pairs = list(zip(dates, cents))[1:]
+        previous = cents[0]
+    else:
+        return [], [], []
+
+    values = [c for _, c in pairs]
+    changes = [c - p for c, p in zip(values, [previous] + values[:-1])]
+    return [d for d, _ in pairs], changes, values
 
 
 class CSVProcessor:
-    def __init__(self, input_csv: TextIO, output_journal: TextIO) -> None:
-        self.input_csv = input_csv
+    """Appends the value changes of one or more funds to a journal.
+
+    Every input CSV has a ``Date`` column and one value column per fund;
+    the ``Value`` column of the Meesman export is the default fund. The
+    last imported date and value of every fund are kept in the import
+    state, so a later run only writes the changes after them.
+    """
+
+    def __init__(self, input_csvs: Sequence[TextIO], output_journal: TextIO,
+                 state: Optional[StateStore] = None,
+                 commit_every: int = 100,
+                 commit_interval: float = 1.0,
+                 durability: Durability = Durability.FLUSH,
+                 partition_by_year: bool = False,
+                 stats: Stats = NO_STATS) -> None:
+        self.input_csvs = input_csvs
         self.output_journal = output_journal
+        self.stats = stats
+        self.state = state or StateStore()
+        self.writer = open_writer(output_journal, self.state,
+                                  partition_by_year=partition_by_year,
+                                  commit_every=commit_every,
+                                  commit_interval=commit_interval,
+                                  durability=durability, stats=stats)
+
+    def read_series(self) -> Dict[str, Series]:
+        parts: Dict[str, List[Series]] = {}
+
+        for input_csv in self.input_csvs:
+            with self.stats.stage('parse'):
+                try:
+                    ingest = Ingest(input_csv)
+                    if ingest.schema.amount is not None:
+                        raise ValueError(f'{ingest.schema.name} exports '
+                                         f'have no fund values')
+                    columns = ingest.series()
+                except ValueError as e:
+                    raise click.ClickException(f'{input_csv.name}: {e}')
+
+                for fund, values in columns.items():
+                    parts.setdefault(fund, []).append(values)
+
+        series = {}
+        for fund, values in parts.items():
+            with self.stats.stage('sort'):
+                if np is not None:
+                    dates = np.concatenate([d for d, _ in values])
+                    cents = np.concatenate([c for _, c in values])
+                else:
+                    dates = [d for part, _ in values for d in part]
+                    cents = [c for _, part in values for c in part]
+                series[fund] = sort_series(dates, cents, fund)
+        return series
 
     def process(self):
-        reader = csv.DictReader(self.input_csv)
+        series = self.read_series()
+        key = self.writer.key
 
-        now = dt.now().strftime("%Y-%m-%d %H:%m:%S")
-        self.output_journal.write(
-            f"; journal created on {now} by CSV import script\n\n")
+        tracked = self.state.get_tracking(key)
+        if tracked is not None and self.writer.size == 0:
+            # The journal was removed or emptied, start over
+            self.state.clear_funds(key)
+            tracked = None
+        elif tracked is None and self.writer.size:
+            tracked = self.seed_state(series)
+        transaction_id = tracked[0] if tracked else -1
 
-        raw_entries = []
+        updates: List[ValueUpdate] = []
+        for fund, values in series.items():
+            last = self.state.get_fund(key, fund)
+            with self.stats.stage('diff'):
+                dates, changes, cents = value_changes(values, last)
 
-        for row in reader:
-            date = parse_date(row['Date'])
-            value = float(row['Value'].replace('.', '').replace(',', '.'))
+            if last is None and len(values[1]):
+                first = to_date(values[0][0]), int(values[1][0])
+                label = '' if fund == DEFAULT_FUND else f' {fund}'
+                print(f"Initial value{label}: "
+                      f"€{Decimal(first[1]).scaleb(-2)}")
+                self.writer.write('', partial(self.state.set_fund, key, fund,
+                                              *first), entry=False)
 
-            raw_entries.append((date, value))
+            updates.extend(zip(dates, [fund] * len(dates), changes, cents))
 
-        entries = sorted(raw_entries, key=lambda x: x[0])
-        last_value = entries[0][1]
+        updates.sort(key=lambda u: u[0])
 
-        print(f"Initial value: €{last_value}")
+        with self.writer:
+            if updates:
+                self.write_header('created' if tracked is None
+                                  else 'continued')
 
-        transaction_id = 0
-        for date, value in entries[1:]:
-            diff_value = value - last_value
-            last_value = value
+            for value_date, fund, change, cents in updates:
+                transaction_id += 1
+                self.writer.write(
+                    self.value_update(transaction_id, value_date, fund,
+                                      change),
+                    partial(self.state.set_fund, key, fund, value_date,
+                            cents),
+                    partial(self.state.set_current_id, key, transaction_id))
 
-            full_trans_id = '{}-M-{}'.format(date.year, transaction_id)
+        print(f"Value updates: {len(updates)}")
 
-            date_str = date.strftime("%Y-%m-%d")
-            entry = JournalEntry(date,
-                                 f'{full_trans_id} - ' +
-                                 f'Meesman value update {date_str}')
-            entry.account1 = Account(
-                AssetAccounts.INVESTMENT_FUND, diff_value)
-            entry.account2 = Account(
-                IncomeAccounts.INVESTMENT_FUND_RETURN, -diff_value)
+    def seed_state(self, series: Dict[str, Series]) \
+            -> Optional[Tuple[int, bool]]:
+        """Continue a journal written without import state.
 
-            self.output_journal.write(entry.journal_str)
+        The value updates already in the journal, e.g. by the script that
+        rewrote the whole journal on every run, give the last date of
+        every fund; its value is taken from the input on that date.
+        """
 
-            transaction_id += 1
+        key = self.writer.key
+        last_id, last_dates = imported_updates(self.output_journal.name)
+        if last_id < 0:
+            return None
+
+        with self.state.transaction():
+            for fund, last_date in last_dates.items():
+                cents = value_on(series[fund], last_date) \
+                    if fund in series else None
+                if cents is None:
+                    raise click.ClickException(
+                        f'{self.output_journal.name} has value updates of '
+                        f'fund {fund!r} up to {last_date}, but the input has '
+                        f'no value on that date to continue from')
+                self.state.set_fund(key, fund, last_date, cents)
+            self.state.set_current_id(key, last_id)
+
+        print(f"Continuing the value updates up to "
+              f"{max(last_dates.values())} already in the journal")
+        return self.state.get_tracking(key)
+
+    def write_header(self, action: str) -> None:
+        now = dt.now().strftime("%Y-%m-%d %H:%m:%S")
+        self.writer.write(
+            f"; journal {action} on {now} by CSV import script\n\n",
+            entry=False)
+
+    @staticmethod
+    def value_update(transaction_id: int, value_date: date, fund: str,
+                     change: int) -> JournalEntry:
+        diff_value = Decimal(change).scaleb(-2)
+        asset, income = fund_accounts(fund)
+
+        full_trans_id = '{}-M-{}'.format(value_date.year, transaction_id)
+        name = 'Meesman' if fund == DEFAULT_FUND else f'Meesman {fund}'
+
+        date_str = value_date.strftime("%Y-%m-%d")
+        return JournalEntry(
+            value_date,
+            f'{full_trans_id} - {name} value update {date_str}',
+            [Account(asset, diff_value), Account(income, -diff_value)])
 
 
 @click.command()
-@click.option('--input-csv', '-i', required=True, type=click.File(mode='r'),
-              help='Input CSV file')
-@click.option('--output-journal', '-o', required=True,
-              type=click.File(mode='w'), help='Output hledger journal file')
-def main(input_csv, output_journal):
-
-    p = CSVProcessor(input_csv, output_journal)
-    p.process()
+@click.option('--input-csv', '-i', 'input_csvs', required=True,
+              multiple=True, type=click.File(mode='r'),
+              help='Input CSV file with a Date column and a value column '
+                   'per fund, can be given multiple times')
+@writer_options
+@profile_options
+def main(input_csvs, output_journal, profile, profile_json, **kwargs):
+
+    with profiling(profile, profile_json) as stats:
+        p = CSVProcessor(input_csvs, output_journal, stats=stats,
+                         **writer_kwargs(**kwargs))
+        p.process()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import click
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CACHE_VERSION = 1
+
+# Reports computed by warm-up, as hledger arguments
+STANDARD_REPORTS = [
+    ['balancesheet'],
+    ['incomestatement', '--monthly'],
+    ['balance', '--monthly', 'Expenses'],
+    ['balance', '--monthly', 'Income'],
+]
+
+
+def journal_path(name: str, year: Optional[str] = None) -> str:
+    """The journal ``hl`` reports on: all.journal or a year's partition."""
+
+    directory = os.path.join(ROOT, 'data', name)
+    return os.path.join(directory, f'{year or "all"}.journal')
+
+
+def _content_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _includes(path: str) -> List[str]:
+    # Only needed for changed journals; importing the journal module (and
+    # with it NumPy) would take longer than answering from the cache
+    from journal import INCLUDE
+
+    # Includes are relative to the including journal and may be globs
+    directory = os.path.dirname(path)
+    targets = []
+    with open(path, 'r') as f:
+        for line in f:
+            m = INCLUDE.match(line) if line.startswith('include') else None
+            if not m:
+                continue
+            target = os.path.join(directory, os.path.expanduser(m.group(1)))
+            targets.extend(sorted(glob.glob(target))
+                           if glob.has_magic(target) else [target])
+    return targets
+
+
+class QueryCache:
+    """hledger output cached by query and journal contents.
+
+    Results are kept in ``directory``, one file per key. The key covers
+    the hledger arguments, the hledger executable, the date (for periods
+    like ``thismonth``) and the size, mtime and content hash of every
+    journal read, following ``include`` directives. Content hashes and
+    includes are remembered per journal by size and mtime, so unchanged
+    journals are only stat'ed. Beyond ``max_size`` bytes the least
+    recently used results are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.files: Dict[str, Dict] = {}
+        self._changed = False
+
+        try:
+            with open(self._files_path(), 'r') as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                self.files = data['files']
+        except (OSError, ValueError):
+            pass
+
+    def _files_path(self) -> str:
+        return os.path.join(self.directory, 'files.json')
+
+    def _result_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.out')
+
+    def _replace(self, path: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def journal_files(self, journal: str) -> List[Tuple[str, int, int, str]]:
+        """Path, size, mtime and content hash of a journal and its
+        includes."""
+
+        result = []
+        pending, seen = [os.path.abspath(journal)], set()
+        while pending:
+            path = pending.pop(0)
+            if path in seen:
+                continue
+            seen.add(path)
+
+            stat = os.stat(path)
+            known = self.files.get(path)
+            if known is None or (known['size'], known['mtime']) != \
+                    (stat.st_size, stat.st_mtime_ns):
+                known = self.files[path] = {
+                    'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                    'hash': _content_hash(path), 'includes': _includes(path)}
+                self._changed = True
+
+            result.append((path, known['size'], known['mtime'],
+                           known['hash']))
+            pending.extend(known['includes'])
+        return result
+
+    def key(self, executable: str, journal: str, args: Sequence[str]) -> str:
+        stat = os.stat(executable)
+        parts = [CACHE_VERSION, executable, stat.st_size, stat.st_mtime_ns,
+                 date.today().isoformat(), os.environ.get('COLUMNS'),
+                 list(args), self.journal_files(journal)]
+        return hashlib.blake2b(json.dumps(parts).encode(),
+                               digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._result_path(key)
+        try:
+            with open(path, 'rb') as f:
+                output = f.read()
+        except OSError:
+            return None
+        # The modification time orders the results for eviction
+        os.utime(path)
+        return output
+
+    def put(self, key: str, output: bytes) -> None:
+        self._replace(self._result_path(key), output)
+        self.evict()
+
+    def evict(self) -> int:
+        """Remove the least recently used results beyond the size limit."""
+
+        results = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.out'):
+                    stat = entry.stat()
+                    results.append((stat.st_mtime_ns, stat.st_size,
+                                    entry.path))
+
+        total = sum(size for _, size, _ in results)
+        removed = 0
+        for _, size, path in sorted(results):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def save(self) -> None:
+        if self._changed:
+            self._replace(self._files_path(), json.dumps(
+                {'version': CACHE_VERSION, 'files': self.files}).encode())
+            self._changed = False
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.files = {}
+
+
+def hledger() -> str:
+    executable = shutil.which('hledger')
+    if executable is None:
+        raise click.ClickException('hledger is not installed')
+    return executable
+
+
+def cached_query(cache: QueryCache, journal: str,
+                 args: Sequence[str]) -> Tuple[bytes, bytes, int]:
+    """Stdout, stderr and exit status of hledger, from the cache when the
+    journals did not change."""
+
+    executable = hledger()
+    key = cache.key(executable, journal, args)
+    output = cache.get(key)
+    if output is not None:
+        return output, b'', 0
+
+    process = subprocess.run([executable, '-f', journal, *args],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode == 0:
+        cache.put(key, process.stdout)
+    return process.stdout, process.stderr, process.returncode
+
+
+@click.group()
+@click.option('--cache-size', default=64, show_default=True,
+              type=click.IntRange(min=0),
+              help='Maximum size of the cached results in MiB')
+@click.pass_context
+def cli(ctx, cache_size):
+    """hledger reports on data/<name> with cached results."""
+
+    ctx.obj = QueryCache(os.path.join(ROOT, '.query_cache'),
+                         cache_size << 20)
+    ctx.call_on_close(ctx.obj.save)
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@click.argument('name')
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+@click.pass_obj
+def run(cache, name, args):
+    """Run hledger on the journal of NAME, like hl.
+
+    When the first argument is a year with a partition, only that year's
+    journal is read.
+    """
+
+    year = None
+    if args and len(args[0]) == 4 and args[0].isdigit() and \
+            os.path.isfile(journal_path(name, args[0])):
+        year, args = args[0], args[1:]
+
+    journal = journal_path(name, year)
+    if not os.path.isfile(journal):
+        raise click.ClickException(f'{journal} does not exist')
+
+    output, errors, status = cached_query(cache, journal, args)
+    sys.stdout.buffer.write(output)
+    sys.stderr.buffer.write(errors)
+    sys.exit(status)
+
+
+@cli.command()
+@click.argument('names', nargs=-1, required=True)
+@click.pass_obj
+def warm(cache, names):
+    """Compute the standard reports of NAMES ahead, e.g. after an import."""
+
+    for name in names:
+        journal = journal_path(name)
+        for args in STANDARD_REPORTS:
+            _, errors, status = cached_query(cache, journal, args)
+            if status:
+                click.echo(errors.decode(errors='replace'), err=True,
+                           nl=False)
+        click.echo(f'{name}: {len(STANDARD_REPORTS)} reports')
+
+
+@cli.command()
+@click.pass_obj
+def clear(cache):
+    """Remove all cached results."""
+
+    cache.clear()
+
+
+if __name__ == "__main__":
+    cli()
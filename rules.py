@@ -0,0 +1,287 @@
+import re
+import time
+
+from collections import namedtuple
+from decimal import Decimal
+from enum import Enum
+from typing import (Callable, Dict, Iterable, List, Optional, Pattern,
+                    Sequence, Tuple)
+
+from stats import Stats
+from util import AssetAccounts, ExpenseAccounts, IncomeAccounts, MiscAccounts
+
+Classification = namedtuple('Classification',
+                            ['account', 'ask', 'unknown', 'rule'])
+
+AmountPredicate = Callable[[Decimal], bool]
+# Whether any pattern matches a description, and a memoized test per pattern
+Matcher = Tuple[bool, Callable[[Pattern], bool]]
+
+
+def expense(amount: Decimal) -> bool:
+    return amount < 0
+
+
+def tuition_fees(amount: Decimal) -> bool:
+    return expense(amount) and abs(amount) >= 1900
+
+
+def not_board_grant(amount: Decimal) -> bool:
+    return amount != 275
+
+
+class Rule:
+    """A single categorization rule.
+
+    The rule applies when its amount predicate holds and every condition
+    matches. A condition is a list of alternative patterns, the first one is
+    given positionally and further AND-conditions through ``also``. A rule
+    without patterns always matches and acts as a fallback.
+    """
+
+    def __init__(self, account: Enum, *patterns: str,
+                 also: Sequence[Sequence[str]] = (),
+                 amount: Optional[AmountPredicate] = None,
+                 ask: bool = False,
+                 ask_unless: Sequence[str] = (),
+                 ask_amount: Optional[AmountPredicate] = None,
+                 unknown: bool = False,
+                 name: Optional[str] = None) -> None:
+        self.account = account
+        self.patterns: List[Tuple[str, ...]] = \
+            [tuple(patterns)] + [tuple(p) for p in also] \
+            if patterns else []
+        self.amount = amount
+        self.ask = ask
+        self.ask_unless = tuple(ask_unless)
+        self.ask_amount = ask_amount
+        self.unknown = unknown
+        self.name = name or (patterns[0] if patterns else 'default')
+
+    def __repr__(self) -> str:
+        return f'Rule({self.name!r} -> {self.account.value!r})'
+
+
+class RuleSet:
+    """Ordered rules, compiled once; the first matching rule wins.
+
+    Patterns are matched case-insensitively against the first line of the
+    description, like the ``'.*(a|b|c).*'`` patterns they replace. All
+    patterns are also combined into a single expression, so a description
+    that hits no keyword at all is resolved with one scan. Otherwise every
+    distinct condition is searched at most once per description.
+    """
+
+    def __init__(self, rules: Sequence[Rule]) -> None:
+        self.rules = list(rules)
+        self._compiled: Dict[Tuple[str, ...], Pattern] = {}
+
+        for rule in self.rules:
+            rule.conditions = [self._compile(p) for p in rule.patterns]
+            rule.ask_condition = self._compile(rule.ask_unless) \
+                if rule.ask_unless else None
+
+        self._predicates = list(dict.fromkeys(
+            p for rule in self.rules for p in (rule.amount, rule.ask_amount)
+            if p is not None))
+
+        all_patterns = [p for rule in self.rules
+                        for condition in rule.patterns for p in condition]
+        self._any = self._compile(tuple(dict.fromkeys(all_patterns))) \
+            if all_patterns else None
+
+    def _compile(self, patterns: Tuple[str, ...]) -> Pattern:
+        if patterns not in self._compiled:
+            self._compiled[patterns] = re.compile(
+                '(?:' + '|'.join(patterns) + ')', re.IGNORECASE)
+        return self._compiled[patterns]
+
+    @staticmethod
+    def _search(pattern: Pattern, s: str, limit: int) -> bool:
+        # The leftmost match has to start on the first line, which is
+        # exactly what '.*(...)' accepted with re.match.
+        m = pattern.search(s)
+        return m is not None and m.start() <= limit
+
+    def _matcher(self, description: str) -> Matcher:
+        newline = description.find('\n')
+        limit = len(description) if newline < 0 else newline
+
+        any_hit = self._any is not None and \
+            self._search(self._any, description, limit)
+        memo: Dict[int, bool] = {}
+
+        def test(pattern: Pattern) -> bool:
+            key = id(pattern)
+            if key not in memo:
+                memo[key] = self._search(pattern, description, limit)
+            return memo[key]
+
+        return any_hit, test
+
+    def classify(self, description: str, amount: Decimal,
+                 stats: Optional[Stats] = None) -> Classification:
+        any_hit, test = self._matcher(description)
+        return self._first(description, amount, any_hit, test, stats)
+
+    def classify_many(self, items: Iterable[Tuple[str, Decimal]]) \
+            -> List[Classification]:
+        """Classify many transactions at once.
+
+        Which patterns match only depends on the description and the amount
+        only matters through the amount predicates, so transactions that
+        agree on both share their classification.
+        """
+
+        matchers: Dict[str, Matcher] = {}
+        known: Dict[Tuple[str, Tuple[bool, ...]], Classification] = {}
+        results = []
+        for description, amount in items:
+            key = (description, tuple(p(amount) for p in self._predicates))
+            classification = known.get(key)
+            if classification is None:
+                matcher = matchers.get(description)
+                if matcher is None:
+                    matcher = matchers[description] = \
+                        self._matcher(description)
+                classification = known[key] = self._first(
+                    description, amount, *matcher)
+            results.append(classification)
+        return results
+
+    def _first(self, description: str, amount: Decimal, any_hit: bool,
+               test: Callable[[Pattern], bool],
+               stats: Optional[Stats] = None) -> Classification:
+        for rule in self.rules:
+            if stats is not None:
+                start = time.perf_counter()
+
+            matched = \
+                (rule.amount is None or rule.amount(amount)) and \
+                (not rule.conditions or
+                 (any_hit and all(map(test, rule.conditions))))
+
+            if stats is not None:
+                stats.rule(rule, time.perf_counter() - start, matched)
+
+            if not matched:
+                continue
+
+            ask = rule.ask or \
+                (rule.ask_condition is not None and
+                 not test(rule.ask_condition)) or \
+                (rule.ask_amount is not None and rule.ask_amount(amount))
+
+            return Classification(rule.account, bool(ask), rule.unknown,
+                                  rule)
+
+        raise ValueError(
+            f"No rule matched transaction '{description}' ({amount})")
+
+
+FOOD_KEYWORDS = [
+    'eten',
+    'gnocchi',
+    'pasta',
+    'wraps',
+    'thais',
+    'indiaas',
+    'roti',
+    'pizza',
+    'lasagne',
+    'stamppot',
+    'boerenkool',
+    'risotto',
+    'chinees',
+    'sushi',
+    'wok'
+]
+
+ING_RULES = RuleSet([
+    Rule(AssetAccounts.BANK_SAVINGS, 'spaarrekening'),
+
+    # === Expenses
+    Rule(ExpenseAccounts.FOOD_AND_GROCERIES,
+         'Albert Heijn',
+         'AH to Go',
+         'AH togo',
+         'AH Station',
+         'Lidl',
+         'Jumbo',
+         'Dirk',
+         'Spar sciencepark',
+         'UvAScience',
+         'Fuameh',
+         'Smullers',
+         'McDonald(?:\'|\\s)?s',
+         r'\bMcD\b',
+         'Broodzaak',
+         r"Julia'?s",
+         'Thuisbezorgd',
+         *FOOD_KEYWORDS,
+         amount=expense, name='groceries'),
+    Rule(ExpenseAccounts.FOOD_AND_GROCERIES,
+         'VERENIGING INFORMATIEWETENSCH.AMSTERDAM',
+         ask_unless=['Afschrijving POS'],
+         amount=expense),
+    Rule(ExpenseAccounts.ALCOHOL,
+         'Maslow',
+         'DE HEEREN VAN AEMS',
+         'Gall & Gall',
+         'Chupitos',
+         'Jeda Horeca',  # De Gieter
+         'HOTSHOTS',
+         'Bier',
+         'Wodka',
+         amount=expense, name='alcohol'),
+    Rule(MiscAccounts.TRANSFER, 'Incasso Creditcard', amount=expense),
+    Rule(ExpenseAccounts.PHONE_SUBSCRIPTION, 'SIMYO', amount=expense),
+    Rule(ExpenseAccounts.DONATIONS, 'UNICEF', amount=expense),
+    Rule(ExpenseAccounts.PUBLIC_TRANSPORT,
+         r'\bNS\b',
+         'OV-Chipkaart',
+         amount=expense, name='public transport'),
+    Rule(ExpenseAccounts.DOMAIN_NAME, 'Transip', amount=expense),
+    Rule(ExpenseAccounts.RENT, 'De Key', also=[['huur']], amount=expense),
+    Rule(ExpenseAccounts.HEALTH_INSURANCE, 'Zorgverzekering',
+         amount=expense),
+    Rule(ExpenseAccounts.OTHER_INSURANCE, 'Verzekering', 'Verzekeraar',
+         amount=expense),
+    Rule(ExpenseAccounts.LIABILITY_INSURANCE, 'AEGON', amount=expense),
+    Rule(ExpenseAccounts.SPORT, 'Sportexpl.mij', amount=expense),  # = USC
+    Rule(ExpenseAccounts.HAIRDRESSER, 'Basic Kappers', amount=expense),
+    Rule(ExpenseAccounts.TAX, 'Belastingdienst', amount=expense),
+    Rule(ExpenseAccounts.DENTIST, 'Infomedics', amount=expense),
+    Rule(ExpenseAccounts.CLOTHING,
+         r'H\s?&\s?M',
+         r'van\s?Haren',
+         amount=expense, name='clothing'),
+    Rule(ExpenseAccounts.TUITION_FEES, 'Universiteit van Amsterdam',
+         amount=tuition_fees, name='tuition fees'),
+    Rule(ExpenseAccounts.FOOD_AND_GROCERIES, 'Betaalverzoek', ask=True,
+         amount=expense),
+    Rule(ExpenseAccounts.ALCOHOL,
+         r'\bCafe\b',
+         'bier',
+         ask=True, amount=expense, name='cafe'),
+    Rule(ExpenseAccounts.MISC, unknown=True, amount=expense,
+         name='unknown expense'),
+
+    # === Income
+    Rule(IncomeAccounts.SALARY_SSL, 'ST.STUDIEBEGELEIDING LDN'),
+    Rule(IncomeAccounts.SALARY_HZFP, 'HET ZWARTE FIETSENPLAN'),
+    Rule(IncomeAccounts.STUDENT_GRANTS,
+         r'\bDUO\b',
+         'Dienst Uitvoering Onderwijs',
+         'Studiefinanciering',
+         name='student grants'),
+    Rule(IncomeAccounts.RENT_ALLOWANCE, 'Huurtoeslag'),
+    Rule(IncomeAccounts.HEALTH_ALLOWANCE, 'Zorgtoeslag'),
+    Rule(IncomeAccounts.BOARD_GRANT, 'Universiteit van Amsterdam',
+         ask_amount=not_board_grant, name='board grant'),
+    Rule(ExpenseAccounts.FOOD_AND_GROCERIES, 'Betaalverzoek',
+         also=[FOOD_KEYWORDS], name='food payment request'),
+    Rule(ExpenseAccounts.FOOD_AND_GROCERIES, *FOOD_KEYWORDS, ask=True,
+         name='food income'),
+    Rule(IncomeAccounts.OTHER, unknown=True, name='unknown income'),
+])
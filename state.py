@@ -0,0 +1,408 @@
+import os
+import sqlite3
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from typing import (Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple)
+
+LEGACY_TRACKING_FILE = '.import_csv_tracking'
+
+ReviewItem = namedtuple('ReviewItem', [
+    'journal', 'source', 'transaction_id', 'date', 'amount', 'name',
+    'comment', 'account', 'ask', 'unknown'])
+
+
+# Columns that hold a file key, see ``StateStore.key``
+FILE_KEY_COLUMNS = [('tracking', 'filename'), ('journals', 'filename'),
+                    ('review_queue', 'journal'), ('review_queue', 'source'),
+                    ('funds', 'journal'), ('balances', 'journal')]
+
+
+def file_key(filename: str, root: Optional[str] = None) -> str:
+    """Identity under which the import state of a file is stored.
+
+    Existing files are identified by their real path, relative to
+    ``root`` when given.
+    """
+    if os.path.exists(filename):
+        path = os.path.realpath(filename)
+        return path if root is None else os.path.relpath(path, root)
+    return filename
+
+
+class StateStore:
+    """Import state kept in a SQLite database in WAL mode.
+
+    Every write happens in a transaction; writes done inside a
+    ``with store.transaction():`` block are committed together.
+
+    Files are keyed on their path relative to the directory of the
+    database, so the state stays valid when the tree is moved or cloned
+    elsewhere together with it.
+    """
+
+    def __init__(self, path: str = '.import_state.sqlite') -> None:
+        self.path = path
+        self.root = os.path.dirname(os.path.realpath(path))
+        is_new = not os.path.exists(path)
+
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self._depth = 0
+
+        with self.transaction():
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS tracking ('
+                'filename TEXT PRIMARY KEY, '
+                'current_id INTEGER NOT NULL)')
+            columns = [c[1] for c in self.db.execute(
+                'PRAGMA table_info(tracking)')]
+            if 'indexed' not in columns:
+                self.db.execute(
+                    'ALTER TABLE tracking '
+                    'ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS journals ('
+                'filename TEXT PRIMARY KEY, '
+                'size INTEGER NOT NULL, '
+                'pending INTEGER NOT NULL DEFAULT 0)')
+            columns = [c[1] for c in self.db.execute(
+                'PRAGMA table_info(journals)')]
+            if 'balanced' not in columns:
+                self.db.execute(
+                    'ALTER TABLE journals '
+                    'ADD COLUMN balanced INTEGER NOT NULL DEFAULT 0')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS review_queue ('
+                'journal TEXT NOT NULL, '
+                'source TEXT NOT NULL, '
+                'transaction_id INTEGER NOT NULL, '
+                'date TEXT NOT NULL, '
+                'amount TEXT NOT NULL, '
+                'name TEXT NOT NULL, '
+                'comment TEXT NOT NULL, '
+                'account TEXT NOT NULL, '
+                'ask INTEGER NOT NULL, '
+                'unknown INTEGER NOT NULL, '
+                'PRIMARY KEY (journal, source, transaction_id))')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'fingerprint BLOB PRIMARY KEY) WITHOUT ROWID')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS answers ('
+                'key TEXT PRIMARY KEY, '
+                'account TEXT NOT NULL, '
+                'learned REAL NOT NULL, '
+                'used REAL NOT NULL)')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS answers_used ON answers (used)')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS models ('
+                'name TEXT PRIMARY KEY, '
+                'data BLOB NOT NULL)')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS funds ('
+                'journal TEXT NOT NULL, '
+                'fund TEXT NOT NULL, '
+                'date TEXT NOT NULL, '
+                'cents INTEGER NOT NULL, '
+                'PRIMARY KEY (journal, fund))')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS balances ('
+                'journal TEXT NOT NULL, '
+                'account TEXT NOT NULL, '
+                'month TEXT NOT NULL, '
+                'cents INTEGER NOT NULL, '
+                'PRIMARY KEY (journal, account, month)) WITHOUT ROWID')
+
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS replays ('
+                'description TEXT NOT NULL, '
+                'amount TEXT NOT NULL, '
+                'account TEXT NOT NULL, '
+                'PRIMARY KEY (description, amount)) WITHOUT ROWID')
+
+            if is_new and os.path.isfile(LEGACY_TRACKING_FILE):
+                self._import_legacy(LEGACY_TRACKING_FILE)
+            self._relativize_keys()
+
+    def key(self, filename: str) -> str:
+        """Key of a file in this store."""
+        return file_key(filename, self.root)
+
+    def _relativize_keys(self) -> None:
+        # Older versions keyed files on their absolute path
+        for table, column in FILE_KEY_COLUMNS:
+            for (old,) in self.db.execute(
+                    f'SELECT DISTINCT {column} FROM {table}').fetchall():
+                if not os.path.isabs(old):
+                    continue
+                self.db.execute(
+                    f'UPDATE OR REPLACE {table} SET {column} = ? '
+                    f'WHERE {column} = ?',
+                    (os.path.relpath(old, self.root), old))
+                if table == 'tracking':
+                    # The fingerprints of the rows imported so far were
+                    # scoped by the absolute journal path, so those rows
+                    # are known by position again until they are indexed
+                    self.db.execute(
+                        'UPDATE tracking SET indexed = 0 WHERE filename = ?',
+                        (os.path.relpath(old, self.root),))
+
+    def _import_legacy(self, fn: str) -> None:
+        with open(fn, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                filename, current_id = line.strip().rsplit(':', 1)
+                self.set_current_id(self.key(filename), int(current_id),
+                                    indexed=False)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        if self._depth == 0:
+            self.db.execute('BEGIN IMMEDIATE')
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self.db.execute('ROLLBACK')
+            raise
+        else:
+            self._depth -= 1
+            if self._depth == 0:
+                self.db.execute('COMMIT')
+
+    @classmethod
+    def open_readonly(cls, path: str) -> 'StateStore':
+        store = cls.__new__(cls)
+        store.path = path
+        store.root = os.path.dirname(os.path.realpath(path))
+        store.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                                   isolation_level=None)
+        store._depth = 0
+        return store
+
+    def get_tracking(self, filename: str) -> Optional[Tuple[int, bool]]:
+        row = self.db.execute(
+            'SELECT current_id, indexed FROM tracking WHERE filename = ?',
+            (filename,)).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def set_current_id(self, filename: str, current_id: int,
+                       indexed: bool = True) -> None:
+        # Setting the current ID means every row up to it has its
+        # fingerprint in the index, legacy state is imported unindexed.
+        with self.transaction():
+            self.db.execute(
+                'INSERT INTO tracking (filename, current_id, indexed) '
+                'VALUES (?, ?, ?) ON CONFLICT (filename) '
+                'DO UPDATE SET current_id = excluded.current_id, '
+                'indexed = excluded.indexed',
+                (filename, current_id, int(indexed)))
+
+    def has_fingerprint(self, fingerprint: bytes) -> bool:
+        return self.db.execute(
+            'SELECT 1 FROM fingerprints WHERE fingerprint = ?',
+            (fingerprint,)).fetchone() is not None
+
+    def add_fingerprint(self, fingerprint: bytes) -> None:
+        with self.transaction():
+            self.db.execute(
+                'INSERT OR IGNORE INTO fingerprints VALUES (?)',
+                (fingerprint,))
+
+    def get_journal(self, filename: str) -> Optional[Tuple[int, bool]]:
+        row = self.db.execute(
+            'SELECT size, pending FROM journals WHERE filename = ?',
+            (filename,)).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def set_journal(self, filename: str, size: int,
+                    pending: bool = False) -> None:
+        with self.transaction():
+            self.db.execute(
+                'INSERT INTO journals (filename, size, pending) '
+                'VALUES (?, ?, ?) ON CONFLICT (filename) '
+                'DO UPDATE SET size = excluded.size, '
+                'pending = excluded.pending',
+                (filename, size, int(pending)))
+
+    def queue_review(self, item: ReviewItem) -> None:
+        with self.transaction():
+            self.db.execute(
+                'INSERT OR REPLACE INTO review_queue VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (item.journal, item.source, item.transaction_id,
+                 item.date.isoformat(), str(item.amount), item.name,
+                 item.comment, item.account, int(item.ask),
+                 int(item.unknown)))
+
+    def review_queue(self, journal: str) -> List[ReviewItem]:
+        rows = self.db.execute(
+            'SELECT * FROM review_queue WHERE journal = ? '
+            'ORDER BY date, source, transaction_id', (journal,))
+        return [ReviewItem(journal, source, transaction_id,
+                           date.fromisoformat(date_str), Decimal(amount),
+                           name, comment, account, bool(ask), bool(unknown))
+                for (journal, source, transaction_id, date_str, amount,
+                     name, comment, account, ask, unknown) in rows]
+
+    def remove_review(self, item: ReviewItem) -> None:
+        with self.transaction():
+            self.db.execute(
+                'DELETE FROM review_queue '
+                'WHERE journal = ? AND source = ? AND transaction_id = ?',
+                (item.journal, item.source, item.transaction_id))
+
+    def get_answer(self, key: str,
+                   max_age: Optional[float] = None) -> Optional[str]:
+        """Return the account learned for ``key`` and mark it as used.
+
+        Answers learned more than ``max_age`` seconds ago are ignored.
+        """
+
+        now = time.time()
+        row = self.db.execute(
+            'SELECT account, learned FROM answers WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or (max_age is not None and row[1] < now - max_age):
+            return None
+
+        with self.transaction():
+            self.db.execute('UPDATE answers SET used = ? WHERE key = ?',
+                            (now, key))
+        return row[0]
+
+    def set_answer(self, key: str, account: str,
+                   max_entries: Optional[int] = None) -> None:
+        """Store an answer, keeping at most ``max_entries`` answers."""
+
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                'INSERT INTO answers (key, account, learned, used) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (key) '
+                'DO UPDATE SET account = excluded.account, '
+                'learned = excluded.learned, used = excluded.used',
+                (key, account, now, now))
+            if max_entries is not None:
+                self.db.execute(
+                    'DELETE FROM answers WHERE key IN ('
+                    'SELECT key FROM answers ORDER BY used DESC '
+                    'LIMIT -1 OFFSET ?)', (max_entries,))
+
+    def expire_answers(self, max_age: float) -> None:
+        with self.transaction():
+            self.db.execute('DELETE FROM answers WHERE learned < ?',
+                            (time.time() - max_age,))
+
+    def get_fund(self, journal: str,
+                 fund: str) -> Optional[Tuple[date, int]]:
+        """Date and value in cents of the last imported fund value."""
+
+        row = self.db.execute(
+            'SELECT date, cents FROM funds WHERE journal = ? AND fund = ?',
+            (journal, fund)).fetchone()
+        return (date.fromisoformat(row[0]), row[1]) if row else None
+
+    def set_fund(self, journal: str, fund: str, value_date: date,
+                 cents: int) -> None:
+        with self.transaction():
+            self.db.execute(
+                'INSERT OR REPLACE INTO funds VALUES (?, ?, ?, ?)',
+                (journal, fund, value_date.isoformat(), cents))
+
+    def clear_funds(self, journal: str) -> None:
+        with self.transaction():
+            self.db.execute('DELETE FROM funds WHERE journal = ?',
+                            (journal,))
+
+    def get_model(self, name: str) -> Optional[bytes]:
+        row = self.db.execute('SELECT data FROM models WHERE name = ?',
+                              (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_model(self, name: str, data: bytes) -> None:
+        with self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO models VALUES (?, ?)',
+                            (name, data))
+
+    def is_balanced(self, journal: str) -> bool:
+        """Whether the monthly balances of ``journal`` are complete."""
+
+        row = self.db.execute(
+            'SELECT balanced FROM journals WHERE filename = ?',
+            (journal,)).fetchone()
+        return bool(row and row[0])
+
+    def add_balances(self, journal: str,
+                     changes: Iterable[Tuple[Tuple[str, str], int]]) -> None:
+        """Add cents per (account, 'YYYY-MM') to the monthly balances."""
+
+        with self.transaction():
+            self.db.executemany(
+                'INSERT INTO balances VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (journal, account, month) '
+                'DO UPDATE SET cents = cents + excluded.cents',
+                ((journal, account, month, cents)
+                 for (account, month), cents in changes))
+
+    def set_balances(self, journal: str,
+                     totals: Iterable[Tuple[Tuple[str, str], int]]) -> None:
+        """Replace the monthly balances of a journal and mark them
+        complete."""
+
+        with self.transaction():
+            self.db.execute('DELETE FROM balances WHERE journal = ?',
+                            (journal,))
+            self.add_balances(journal, totals)
+            self.db.execute(
+                'UPDATE journals SET balanced = 1 WHERE filename = ?',
+                (journal,))
+
+    def balances(self, journals: Sequence[str]) -> Dict[Tuple[str, str], int]:
+        """Cents per (account, 'YYYY-MM'), summed over ``journals``."""
+
+        totals: Dict[Tuple[str, str], int] = {}
+        for journal in journals:
+            for account, month, cents in self.db.execute(
+                    'SELECT account, month, cents FROM balances '
+                    'WHERE journal = ?', (journal,)):
+                key = (account, month)
+                totals[key] = totals.get(key, 0) + cents
+        return totals
+
+    def replays(self) -> Dict[Tuple[str, Decimal], str]:
+        """Account per (description, amount) accepted by a replay."""
+
+        return {(description, Decimal(amount)): account
+                for description, amount, account in self.db.execute(
+                    'SELECT description, amount, account FROM replays')}
+
+    def set_replays(self, accounts: Iterable[Tuple[Tuple[str, Decimal],
+                                                   str]]) -> None:
+        with self.transaction():
+            self.db.executemany(
+                'INSERT OR REPLACE INTO replays VALUES (?, ?, ?)',
+                ((description, str(amount), account)
+                 for (description, amount), account in accounts))
+
+    def set_synchronous(self, mode: str) -> None:
+        self.db.execute(f'PRAGMA synchronous={mode}')
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,152 @@
+import json
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO
+
+import click
+
+
+class Stats:
+    """Wall time per pipeline stage and hit counts per categorization rule.
+
+    Stage times are exclusive: while a nested stage runs (e.g. ``parse``
+    pulling rows from ``read``), the outer stage is paused. A disabled
+    instance does no timing at all.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.rules: Dict[Any, List[float]] = {}
+        self._stack: List[str] = []
+        self._mark = 0.0
+        self._start = time.perf_counter()
+        self._end: Optional[float] = None
+
+    def _switch(self) -> None:
+        now = time.perf_counter()
+        if self._stack:
+            self.stages[self._stack[-1]] += now - self._mark
+        self._mark = now
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def stage(self, name: str):
+        return self._stage(name) if self.enabled else nullcontext()
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        """Charge the time spent producing each item to stage ``name``."""
+
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name: str, it: Iterator) -> Iterator:
+        while True:
+            with self._stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def rule(self, rule: Any, seconds: float, hit: bool) -> None:
+        record = self.rules.setdefault(rule, [0, 0.0])
+        record[0] += hit
+        record[1] += seconds
+
+    def merge(self, other: 'Stats') -> None:
+        """Add the stage times and rule hits of ``other``, e.g. of a
+        background thread. Its stages ran alongside the ones of this
+        instance, so the shares can add up to more than 100%."""
+
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        for rule, (hits, seconds) in other.rules.items():
+            record = self.rules.setdefault(rule, [0, 0.0])
+            record[0] += hits
+            record[1] += seconds
+
+    def stop(self) -> None:
+        self._end = time.perf_counter()
+
+    @property
+    def total(self) -> float:
+        return (self._end or time.perf_counter()) - self._start
+
+    def as_dict(self, rules: Iterable[Any] = ()) -> Dict:
+        stages = dict(self.stages)
+        stages['other'] = max(self.total - sum(stages.values()), 0.0)
+
+        return {
+            'total_seconds': self.total,
+            'stages': stages,
+            'rules': [{'rule': rule.name,
+                       'account': rule.account.value,
+                       'hits': self.rules.get(rule, [0, 0.0])[0],
+                       'seconds': self.rules.get(rule, [0, 0.0])[1]}
+                      for rule in rules],
+        }
+
+    def write_json(self, f: TextIO, rules: Iterable[Any] = ()) -> None:
+        json.dump(self.as_dict(rules), f, indent=2)
+        f.write('\n')
+
+    def print_table(self, rules: Iterable[Any] = ()) -> None:
+        data = self.as_dict(rules)
+        total = data['total_seconds']
+
+        click.echo(click.style(f"\n{'Stage':<20s}{'Time':>12s}{'Share':>9s}",
+                               bold=True), err=True)
+        for name, seconds in data['stages'].items():
+            share = seconds / total if total else 0
+            click.echo(f'{name:<20s}{seconds:>11.3f}s{share:>9.1%}',
+                       err=True)
+        click.echo(f"{'total':<20s}{total:>11.3f}s", err=True)
+
+        if not data['rules']:
+            return
+
+        click.echo(click.style(
+            f"\n{'Rule':<28s}{'Account':<32s}{'Hits':>8s}{'Time':>11s}",
+            bold=True), err=True)
+        for r in data['rules']:
+            line = (f"{r['rule'][:27]:<28s}{r['account'][:31]:<32s}"
+                    f"{r['hits']:>8d}{r['seconds']:>10.3f}s")
+            click.echo(click.style(line, dim=not r['hits']), err=True)
+
+
+NO_STATS = Stats(enabled=False)
+
+
+def profile_options(f):
+    f = click.option('--profile-json', type=click.File(mode='w'),
+                     help='Write the --profile report as JSON to this '
+                          'file')(f)
+    f = click.option('--profile', is_flag=True,
+                     help='Print the time spent per stage and the hits '
+                          'per categorization rule')(f)
+    return f
+
+
+@contextmanager
+def profiling(profile: bool, profile_json: Optional[TextIO],
+              rules: Iterable[Any] = ()) -> Iterator[Stats]:
+    stats = Stats() if profile or profile_json else NO_STATS
+    yield stats
+
+    stats.stop()
+    if profile:
+        stats.print_table(rules)
+    if profile_json:
+        stats.write_json(profile_json, rules)
@@ -0,0 +1,244 @@
+import math
+import os
+import pickle
+import re
+
+from collections import Counter, defaultdict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from journal import read_journal
+from state import StateStore
+from util import AssetAccounts, JournalEntry
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WORD = re.compile(r'[^\W\d_]{2,}')
+TRANSACTION_ID = re.compile(r'\d{4}-\d+ - ')
+
+# Suggestions are the most likely accounts with their probability
+Suggestions = List[Tuple[str, float]]
+
+
+def tokens(description: str, amount: Decimal) -> List[str]:
+    """Features of a transaction: its words and its direction."""
+
+    words = WORD.findall(description.split('\n', 1)[0].lower())
+    return ['-' if amount < 0 else '+'] + words
+
+
+def training_example(entry: JournalEntry) \
+        -> Optional[Tuple[str, Decimal, str]]:
+    """Description, amount and account of an imported bank transaction."""
+
+    if len(entry.postings) != 2 or 'UNKNOWN_TRANSACTION' in entry.tags:
+        return None
+
+    bank, other = entry.postings
+    if getattr(bank.name, 'value', bank.name) != \
+            AssetAccounts.BANK_PAYMENT_ACCOUNT.value:
+        return None
+
+    description = entry.description
+    m = TRANSACTION_ID.match(description)
+    if m:
+        description = description[m.end():]
+    return description, bank.value, getattr(other.name, 'value', other.name)
+
+
+class Suggester:
+    """Multinomial naive Bayes over the words of transaction descriptions.
+
+    The model only keeps counts, so it is trained incrementally: journals
+    are read from the byte offset where the previous training stopped.
+    ``predict_batch`` scores many transactions at once, with NumPy when it
+    is available.
+    """
+
+    MODEL = 'suggester'
+
+    def __init__(self, alpha: float = 0.1) -> None:
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self) -> None:
+        self.accounts: List[str] = []
+        self.account_counts: List[int] = []
+        self.token_counts: Dict[str, Dict[int, int]] = defaultdict(Counter)
+        self.account_tokens: List[int] = []
+        self.sources: Dict[str, int] = {}
+        self._tables = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['token_counts'] = dict(self.token_counts)
+        state['_tables'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.token_counts = defaultdict(Counter, self.token_counts)
+
+    @classmethod
+    def load(cls, state: StateStore) -> 'Suggester':
+        data = state.get_model(cls.MODEL)
+        if not data:
+            return cls()
+
+        suggester = pickle.loads(data)
+        # Older versions keyed the journals on their absolute path. When
+        # one of them is gone, the tree may have moved since, and training
+        # on it again under its new key would count its entries twice.
+        old = [key for key in suggester.sources if os.path.isabs(key)]
+        if any(not os.path.exists(key) for key in old):
+            suggester.reset()
+        else:
+            for key in old:
+                suggester.sources[os.path.relpath(key, state.root)] = \
+                    suggester.sources.pop(key)
+        return suggester
+
+    def save(self, state: StateStore) -> None:
+        state.set_model(self.MODEL, pickle.dumps(self))
+
+    @property
+    def trained(self) -> bool:
+        return bool(self.accounts)
+
+    def _account_index(self, account: str) -> int:
+        try:
+            return self.accounts.index(account)
+        except ValueError:
+            self.accounts.append(account)
+            self.account_counts.append(0)
+            self.account_tokens.append(0)
+            return len(self.accounts) - 1
+
+    def fit(self, examples: Iterable[Tuple[str, Decimal, str]]) -> None:
+        for description, amount, account in examples:
+            index = self._account_index(account)
+            features = tokens(description, amount)
+
+            self.account_counts[index] += 1
+            self.account_tokens[index] += len(features)
+            for token in features:
+                self.token_counts[token][index] += 1
+
+        self._tables = None
+
+    def train(self, journals: Sequence[str], state: StateStore) -> int:
+        """Train on what was appended to the journals since the last call.
+
+        Included journals are followed. Journals are keyed like in the
+        import state, see ``StateStore.key``. When a journal shrank, it was
+        rewritten and the model is trained again from scratch.
+        """
+
+        def path(key: str) -> str:
+            return os.path.join(state.root, key)
+
+        if any(os.path.exists(path(key)) and
+               os.path.getsize(path(key)) < offset
+               for key, offset in self.sources.items()):
+            self.reset()
+
+        keys = list(dict.fromkeys(
+            [state.key(p) for p in journals] + list(self.sources)))
+        count = 0
+
+        while keys:
+            key = keys.pop(0)
+            if not os.path.isfile(path(key)):
+                continue
+
+            entries, includes, offset = read_journal(
+                path(key), self.sources.get(key, 0))
+            self.sources[key] = offset
+            keys.extend(k for k in map(state.key, includes)
+                        if k not in self.sources and k not in keys)
+
+            examples = [e for e in map(training_example, entries) if e]
+            self.fit(examples)
+            count += len(examples)
+
+        return count
+
+    def _log_priors(self) -> List[float]:
+        total = sum(self.account_counts)
+        return [math.log(c / total) for c in self.account_counts]
+
+    def _log_likelihoods(self, token: str) -> List[float]:
+        counts = self.token_counts.get(token, {})
+        size = len(self.token_counts)
+        return [math.log((counts.get(i, 0) + self.alpha) /
+                         (n + self.alpha * size))
+                for i, n in enumerate(self.account_tokens)]
+
+    def _top(self, scores: Sequence[float], k: int) -> Suggestions:
+        # Softmax of the log scores
+        best = max(scores)
+        weights = [math.exp(s - best) for s in scores]
+        total = sum(weights)
+        ranked = sorted(range(len(scores)), key=lambda i: -weights[i])
+        return [(self.accounts[i], weights[i] / total) for i in ranked[:k]]
+
+    def predict(self, description: str, amount: Decimal,
+                k: int = 3) -> Suggestions:
+        if not self.trained:
+            return []
+
+        scores = self._log_priors()
+        for token in tokens(description, amount):
+            if token in self.token_counts:
+                for i, s in enumerate(self._log_likelihoods(token)):
+                    scores[i] += s
+        return self._top(scores, k)
+
+    def _build_tables(self):
+        vocabulary = {t: i for i, t in enumerate(self.token_counts)}
+        counts = np.zeros((len(vocabulary) + 1, len(self.accounts)))
+        for token, row in vocabulary.items():
+            for account, count in self.token_counts[token].items():
+                counts[row, account] = count
+
+        likelihoods = np.log(
+            (counts + self.alpha) /
+            (np.array(self.account_tokens) + self.alpha * len(vocabulary)))
+        # The extra last row scores nothing, see predict_batch
+        likelihoods[-1] = 0
+        self._tables = vocabulary, likelihoods, \
+            np.array(self._log_priors())
+
+    def predict_batch(self, rows: Sequence[Tuple[str, Decimal]],
+                      k: int = 3) -> List[Suggestions]:
+        if not self.trained or not rows:
+            return [[] for _ in rows]
+        if np is None:
+            return [self.predict(d, a, k) for d, a in rows]
+
+        if self._tables is None:
+            self._build_tables()
+        vocabulary, likelihoods, priors = self._tables
+
+        # Sum the known tokens of every row with one segmented reduction;
+        # rows without known tokens get a zero row from the extra index.
+        indices: List[int] = []
+        starts: List[int] = []
+        for description, amount in rows:
+            starts.append(len(indices))
+            indices.extend(vocabulary[t] for t in tokens(description, amount)
+                           if t in vocabulary)
+            indices.append(len(vocabulary))
+
+        scores = np.add.reduceat(likelihoods[indices], starts) + priors
+
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        ranked = np.argsort(-probabilities, axis=1, kind='stable')[:, :k]
+
+        return [[(self.accounts[i], float(p[i])) for i in order]
+                for p, order in zip(probabilities, ranked)]
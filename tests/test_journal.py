@@ -0,0 +1,79 @@
+import os
+import sys
+
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from journal import JournalWriter, PartitionedWriter, read_journal  # noqa
+from state import StateStore  # noqa: E402
+from util import Account, JournalEntry  # noqa: E402
+
+
+def entry(day: int) -> JournalEntry:
+    return JournalEntry(date(2020, 1, day), f'2020-{day} - test', [
+        Account('Assets:Bank', Decimal('1.00')),
+        Account('Income:Other', Decimal('-1.00'))])
+
+
+def fail_once():
+    calls = []
+
+    def callback():
+        if not calls:
+            calls.append(True)
+            raise KeyboardInterrupt
+    return callback
+
+
+@pytest.fixture
+def state(tmp_path):
+    store = StateStore(str(tmp_path / 'state.sqlite'))
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('writer_class', [JournalWriter, PartitionedWriter])
+def test_failed_commit_is_retried_once(tmp_path, state, writer_class):
+    path = str(tmp_path / 'main.journal')
+    with open(path, 'a+') as f:
+        writer = writer_class(f, state, commit_every=1000)
+        writer.write(entry(1).journal_str, source=entry(1))
+        writer.write(entry(2).journal_str, fail_once(), source=entry(2))
+
+        with pytest.raises(KeyboardInterrupt):
+            writer.commit()
+        writer.commit()
+        writer.close()
+
+    entries = []
+    pending = [path]
+    while pending:
+        found, includes, _ = read_journal(pending.pop())
+        entries.extend(found)
+        pending.extend(includes)
+    assert [e.date.day for e in entries] == [1, 2]
+    assert state.balances([state.key(p) for p in [path] + [
+        str(tmp_path / '2020.journal')]])[('Assets:Bank', '2020-01')] == 200
+
+
+def test_exception_does_not_commit(tmp_path, state):
+    path = str(tmp_path / 'main.journal')
+    with open(path, 'a+') as f:
+        with pytest.raises(KeyboardInterrupt):
+            with JournalWriter(f, state, commit_every=1000) as writer:
+                writer.write(entry(1).journal_str, source=entry(1))
+                writer.write(entry(2).journal_str, fail_once(),
+                             source=entry(2))
+                writer.commit()
+
+    # The appended entries were never recorded, reopening cuts them off
+    with open(path, 'a+') as f:
+        JournalWriter(f, state).close()
+    assert os.path.getsize(path) == 0
+    assert state.get_journal(state.key(path)) == (0, False)
+    assert not state.balances([state.key(path)])
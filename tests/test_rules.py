@@ -0,0 +1,152 @@
+import itertools
+import os
+import re
+import sys
+
+from decimal import Decimal
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rules import FOOD_KEYWORDS, ING_RULES  # noqa: E402
+from util import (AssetAccounts, ExpenseAccounts, IncomeAccounts,  # noqa: E402
+                  MiscAccounts)
+
+
+def match(s, *args):
+    reg = re.compile('.*(' + '|'.join(args) + ').*', re.IGNORECASE)
+    return reg.match(s) is not None
+
+
+def chain_classify(description, amount):
+    """The if/elif chain the rule table replaced, as (account, ask,
+    unknown)."""
+
+    ask = False
+    unknown = False
+
+    if match(description, 'spaarrekening'):
+        account2 = AssetAccounts.BANK_SAVINGS
+
+    elif amount < 0:
+        if match(description,
+                 'Albert Heijn', 'AH to Go', 'AH togo', 'AH Station',
+                 'Lidl', 'Jumbo', 'Dirk', 'Spar sciencepark', 'UvAScience',
+                 'Fuameh', 'Smullers', 'McDonald(?:\'|\\s)?s', r'\bMcD\b',
+                 'Broodzaak', r"Julia'?s", 'Thuisbezorgd', *FOOD_KEYWORDS):
+            account2 = ExpenseAccounts.FOOD_AND_GROCERIES
+        elif match(description, 'VERENIGING INFORMATIEWETENSCH.AMSTERDAM'):
+            account2 = ExpenseAccounts.FOOD_AND_GROCERIES
+            if not match(description, 'Afschrijving POS'):
+                ask = True
+        elif match(description, 'Maslow', 'DE HEEREN VAN AEMS',
+                   'Gall & Gall', 'Chupitos', 'Jeda Horeca', 'HOTSHOTS',
+                   'Bier', 'Wodka'):
+            account2 = ExpenseAccounts.ALCOHOL
+        elif match(description, 'Incasso Creditcard'):
+            account2 = MiscAccounts.TRANSFER
+        elif match(description, 'SIMYO'):
+            account2 = ExpenseAccounts.PHONE_SUBSCRIPTION
+        elif match(description, 'UNICEF'):
+            account2 = ExpenseAccounts.DONATIONS
+        elif match(description, r'\bNS\b', 'OV-Chipkaart'):
+            account2 = ExpenseAccounts.PUBLIC_TRANSPORT
+        elif match(description, 'Transip'):
+            account2 = ExpenseAccounts.DOMAIN_NAME
+        elif match(description, 'De Key') and match(description, 'huur'):
+            account2 = ExpenseAccounts.RENT
+        elif match(description, 'Zorgverzekering'):
+            account2 = ExpenseAccounts.HEALTH_INSURANCE
+        elif match(description, 'Verzekering', 'Verzekeraar'):
+            account2 = ExpenseAccounts.OTHER_INSURANCE
+        elif match(description, 'AEGON'):
+            account2 = ExpenseAccounts.LIABILITY_INSURANCE
+        elif match(description, 'Sportexpl.mij'):
+            account2 = ExpenseAccounts.SPORT
+        elif match(description, 'Basic Kappers'):
+            account2 = ExpenseAccounts.HAIRDRESSER
+        elif match(description, 'Belastingdienst'):
+            account2 = ExpenseAccounts.TAX
+        elif match(description, 'Infomedics'):
+            account2 = ExpenseAccounts.DENTIST
+        elif match(description, r'H\s?&\s?M', r'van\s?Haren'):
+            account2 = ExpenseAccounts.CLOTHING
+        elif match(description, 'Universiteit van Amsterdam') and \
+                abs(amount) >= 1900:
+            account2 = ExpenseAccounts.TUITION_FEES
+        elif match(description, 'Betaalverzoek'):
+            account2 = ExpenseAccounts.FOOD_AND_GROCERIES
+            ask = True
+        elif match(description, r'\bCafe\b', 'bier'):
+            account2 = ExpenseAccounts.ALCOHOL
+            ask = True
+        else:
+            account2 = ExpenseAccounts.MISC
+            unknown = True
+
+    else:
+        if match(description, 'ST.STUDIEBEGELEIDING LDN'):
+            account2 = IncomeAccounts.SALARY_SSL
+        elif match(description, 'HET ZWARTE FIETSENPLAN'):
+            account2 = IncomeAccounts.SALARY_HZFP
+        elif match(description, r'\bDUO\b', 'Dienst Uitvoering Onderwijs',
+                   'Studiefinanciering'):
+            account2 = IncomeAccounts.STUDENT_GRANTS
+        elif match(description, 'Huurtoeslag'):
+            account2 = IncomeAccounts.RENT_ALLOWANCE
+        elif match(description, 'Zorgtoeslag'):
+            account2 = IncomeAccounts.HEALTH_ALLOWANCE
+        elif match(description, 'Universiteit van Amsterdam'):
+            account2 = IncomeAccounts.BOARD_GRANT
+            if amount != 275:
+                ask = True
+        elif match(description, 'Betaalverzoek') and \
+                match(description, *FOOD_KEYWORDS):
+            account2 = ExpenseAccounts.FOOD_AND_GROCERIES
+        elif match(description, *FOOD_KEYWORDS):
+            account2 = ExpenseAccounts.FOOD_AND_GROCERIES
+            ask = True
+        else:
+            account2 = IncomeAccounts.OTHER
+            unknown = True
+
+    return account2, ask, unknown
+
+
+# Fragments that overlap between rules, so that combinations of them
+# test which rule takes priority
+FRAGMENTS = [
+    '', 'spaarrekening', 'Albert Heijn', 'eten', 'pizza', 'Dirk',
+    'VERENIGING INFORMATIEWETENSCH.AMSTERDAM', 'Afschrijving POS',
+    'Gall & Gall', 'Bier', 'Incasso Creditcard', 'SIMYO', 'NS', 'NSW',
+    'OV-Chipkaart', 'De Key', 'huur', 'Zorgverzekering',
+    'Schadeverzekering', 'AEGON', 'Belastingdienst', 'Huurtoeslag',
+    'Zorgtoeslag', 'H & M', 'HM', 'Universiteit van Amsterdam',
+    'Betaalverzoek', 'Cafe', 'Cafetaria', 'ST.STUDIEBEGELEIDING LDN',
+    'HET ZWARTE FIETSENPLAN', 'DUO', 'Studiefinanciering', 'McDonald\'s',
+    'McD',
+]
+
+AMOUNTS = [Decimal('-2100.00'), Decimal('-1900.00'), Decimal('-12.50'),
+           Decimal('0.00'), Decimal('12.50'), Decimal('275.00'),
+           Decimal('275.01')]
+
+DESCRIPTIONS = [f'{a} - {b}' for a, b in
+                itertools.combinations(FRAGMENTS, 2)]
+
+
+@pytest.mark.parametrize('amount', AMOUNTS)
+def test_rules_match_the_replaced_chain(amount):
+    for description in DESCRIPTIONS:
+        classification = ING_RULES.classify(description, amount)
+        assert (classification.account, classification.ask,
+                classification.unknown) == \
+            chain_classify(description, amount), description
+
+
+def test_classify_many_matches_classify():
+    items = [(d, a) for d in DESCRIPTIONS for a in AMOUNTS]
+    assert list(ING_RULES.classify_many(items)) == \
+        [ING_RULES.classify(d, a) for d, a in items]
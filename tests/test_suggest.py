@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+
+from datetime import date
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from state import StateStore  # noqa: E402
+from suggest import Suggester  # noqa: E402
+from util import Account, AssetAccounts, JournalEntry  # noqa: E402
+
+
+def write_tree(root):
+    os.makedirs(root)
+    with open(os.path.join(root, 'main.journal'), 'w') as f:
+        f.write('include 2020.journal\n\n')
+    with open(os.path.join(root, '2020.journal'), 'w') as f:
+        for day in range(1, 6):
+            f.write(JournalEntry(date(2020, 1, day), f'2020-{day} - Lidl', [
+                Account(AssetAccounts.BANK_PAYMENT_ACCOUNT, Decimal('-1.00')),
+                Account('Expenses:Food', Decimal('1.00'))]).journal_str)
+
+
+def train(root, absolute=False):
+    state = StateStore(os.path.join(root, 'state.sqlite'))
+    try:
+        suggester = Suggester.load(state)
+        suggester.train([os.path.join(root, 'main.journal')], state)
+        if absolute:
+            # How older versions keyed the journals
+            suggester.sources = {os.path.join(root, k): v
+                                 for k, v in suggester.sources.items()}
+        suggester.save(state)
+        return suggester
+    finally:
+        state.close()
+
+
+def test_moved_tree_is_not_trained_twice(tmp_path):
+    old, new = str(tmp_path / 'old'), str(tmp_path / 'new')
+    write_tree(old)
+    assert train(old).account_counts == [5]
+
+    shutil.move(old, new)
+    suggester = train(new)
+    assert suggester.account_counts == [5]
+    assert sorted(suggester.sources) == ['2020.journal', 'main.journal']
+
+
+def test_absolute_keys_are_migrated(tmp_path):
+    old, new = str(tmp_path / 'old'), str(tmp_path / 'new')
+    write_tree(old)
+    train(old, absolute=True)
+    assert train(old).account_counts == [5]
+
+    train(old, absolute=True)
+    shutil.move(old, new)
+    assert train(new).account_counts == [5]
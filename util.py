@@ -1,8 +1,33 @@
+import csv
+import hashlib
+import heapq
+import io
+import mmap
+import os
+import pickle
+import queue
+import sys
+import tempfile
+import threading
+
 from collections import namedtuple
+from decimal import Decimal
 from enum import Enum
-from typing import Optional, List
+from functools import lru_cache
+from itertools import chain, islice
+from operator import itemgetter
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sequence, TextIO, Tuple, TypeVar,
+                    Union)
 from datetime import date
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+T = TypeVar('T')
+
 Account = namedtuple('Account', ['name', 'value'])
 
 
@@ -50,50 +75,621 @@ class MiscAccounts(Enum):
     TRANSFER = 'Transfer'
 
 
+ACCOUNTS = {e.value: e for e in
+            list(AssetAccounts) +
+            list(ExpenseAccounts) +
+            list(IncomeAccounts) +
+            list(MiscAccounts)}
+
+
+def _posting_property(index: int) -> property:
+    def get(self) -> Optional[Account]:
+        return self.postings[index] if index < len(self.postings) else None
+
+    def set(self, account: Optional[Account]) -> None:
+        postings = self.postings
+        while len(postings) <= index:
+            postings.append(None)
+        postings[index] = account
+        while postings and postings[-1] is None:
+            postings.pop()
+
+    return property(get, set)
+
+
 class JournalEntry:
-    def __init__(self, date: date, description: str) -> None:
+    """An hledger transaction with any number of postings.
+
+    ``account1`` to ``account4`` are kept as views on the first four
+    postings. Account names are account enums or plain strings.
+    """
+
+    __slots__ = ('date', 'description', 'postings', 'tags')
+
+    def __init__(self, date: date, description: str,
+                 postings: Iterable[Account] = ()) -> None:
         self.date = date
         self.description = description
-        self.account1: Optional[Account] = None
-        self.account2: Optional[Account] = None
-        self.account3: Optional[Account] = None
-        self.account4: Optional[Account] = None
+        self.postings: List[Optional[Account]] = list(postings)
         self.tags: List[str] = []
 
+    account1 = _posting_property(0)
+    account2 = _posting_property(1)
+    account3 = _posting_property(2)
+    account4 = _posting_property(3)
+
     def _check(self):
         if not (self.account1 and self.account2):
             raise ValueError(
                 "At least account1 and account2 need to be present")
 
-        s = self.account1.value + self.account2.value
-        if self.account3:
-            s += self.account3.value
+        # Values are exact Decimals for parsed amounts, but floats are still
+        # accepted; those only need to cancel out up to the cent.
+        if round(sum(p.value for p in self.postings if p), 2) != 0:
+            raise ValueError("Sum of account* values is not equal to zero.")
 
-        if self.account4:
-            s += self.account4.value
+    def render(self, parts: List[str]) -> None:
+        """Append the journal text of this entry to ``parts``."""
 
-        if s != 0:
-            raise ValueError("Sum of account* values is not equal to zero.")
+        self._check()
+
+        d = self.date
+        parts.append(f'{d.year:04d}/{d.month:02d}/{d.day:02d} '
+                     f'{self.description}')
+        if self.tags:
+            parts.append(';   ' + ''.join(t + ': ' for t in self.tags))
+        parts.append('\n')
+
+        for posting in self.postings:
+            if posting:
+                name = getattr(posting.name, 'value', posting.name)
+                # hledger needs two spaces between account and amount
+                if len(name) > 38:
+                    name += '  '
+                parts.append(f'    {name:<40s}€{posting.value:.2f}\n')
+
+        parts.append('\n')
 
     @property
     def journal_str(self) -> str:
-        self._check()
+        parts: List[str] = []
+        self.render(parts)
+        return ''.join(parts)
 
-        s = "{} {}".format(self.date.strftime("%Y/%m/%d"), self.description)
 
-        if self.tags:
-            s += ";   "
-            for t in self.tags:
-                s += t + ": "
+def render_journal(items: Iterable[Union[JournalEntry, str]]) -> str:
+    """Render entries with a single join; text, like comments, is copied
+    as it is."""
+
+    parts: List[str] = []
+    for item in items:
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            item.render(parts)
+    return ''.join(parts)
+
+
+def write_journal(entries: Iterable[JournalEntry], f: TextIO,
+                  chunk_size: int = 1000) -> int:
+    """Write entries to ``f`` in chunks, return the number written."""
+
+    count = 0
+    parts: List[str] = []
+    for count, entry in enumerate(entries, 1):
+        entry.render(parts)
+        if count % chunk_size == 0:
+            f.write(''.join(parts))
+            parts = []
+
+    f.write(''.join(parts))
+    return count
+
+
+class MappedCSV:
+    """Selected columns of a CSV file, read through a memory map.
+
+    The file is decoded and parsed in blocks of about ``block_size`` bytes
+    that end on a record boundary, and rows are yielded as tuples of just
+    the requested columns instead of dicts. Streams that cannot be mapped,
+    like a pipe on stdin, are read with ``csv.reader`` directly.
+    """
+
+    def __init__(self, f: TextIO, block_size: int = 1 << 22) -> None:
+        self.f = f
+        self.encoding = getattr(f, 'encoding', None) or 'utf-8'
+        self.block_size = block_size
+        self.map: Optional[mmap.mmap] = None
+        self.start = 0
+
+        try:
+            # Blocks are split on newline bytes, which needs an encoding
+            # that is a superset of ASCII
+            if f.tell() == 0 and os.fstat(f.fileno()).st_size > 0 and \
+                    '\n,"'.encode(self.encoding) == b'\n,"':
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            self.map = None
+
+        if self.map is None:
+            self.reader = csv.reader(f)
+            header = next(self.reader, [])
+        else:
+            end = self.map.find(b'\n')
+            self.start = len(self.map) if end < 0 else end + 1
+            header = next(csv.reader([self.map[:self.start].decode(
+                self.encoding).lstrip('\ufeff')]), [])
+
+        self.header: List[str] = header
+
+    def _blocks(self) -> Iterator[str]:
+        m, pos, end = self.map, self.start, len(self.map)
+
+        while pos < end:
+            stop = min(pos + self.block_size, end)
+            while stop < end:
+                nl = m.find(b'\n', stop - 1)
+                stop = end if nl < 0 else nl + 1
+                # An odd number of quotes means the newline is in a field
+                if m[pos:stop].count(b'"') % 2 == 0:
+                    break
+                stop += 1
+
+            yield m[pos:stop].decode(self.encoding)
+            pos = stop
+
+    def _reader(self) -> Iterator[List[str]]:
+        if self.map is None:
+            return self.reader
+        return chain.from_iterable(
+            csv.reader(io.StringIO(block, newline=''))
+            for block in self._blocks())
+
+    def rows(self, columns: Sequence[str]) -> Iterator[Tuple[str, ...]]:
+        """Yield a tuple with the given columns of every record."""
+
+        indices = [self.header.index(c) for c in columns]
+        if len(indices) == 1:
+            index = indices[0]
+            get: Callable[[List[str]], Tuple[str, ...]] = \
+                lambda row: (row[index],)
+        else:
+            get = itemgetter(*indices)
+
+        # Blank lines are read as empty rows
+        return map(get, filter(None, self._reader()))
+
+    def batches(self, columns: Sequence[str],
+                size: int) -> Iterator[List[List[str]]]:
+        """Yield the given columns of up to ``size`` records at a time."""
+
+        rows = self.rows(columns)
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                return
+            yield [list(column) for column in zip(*chunk)]
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+
+
+@lru_cache(maxsize=4096)
+def parse_date(s: str) -> date:
+    """Parse a date, with a fast path for YYYYMMDD and YYYY-MM-DD.
+
+    Bank exports contain few distinct dates, so results are memoized.
+    """
+
+    if len(s) == 8 and s.isdigit():
+        return date(int(s[:4]), int(s[4:6]), int(s[6:]))
+    if len(s) == 10 and s[4] == '-' and s[7] == '-':
+        return date(int(s[:4]), int(s[5:7]), int(s[8:]))
+
+    from dateutil.parser import parse
+    return parse(s).date()
+
+
+def parse_amount(s: str, sign: str = 'Bij') -> Decimal:
+    """Parse a Dutch formatted amount like '1.234,56'.
+
+    ``sign`` is the value of the 'Af Bij' column, 'Af' makes the amount
+    negative.
+    """
+
+    amount = Decimal(s.replace('.', '').replace(',', '.'))
+    return -amount if sign == 'Af' else amount
+
+
+def parse_cents(s: str, sign: str = 'Bij') -> int:
+    """Parse a Dutch formatted amount into integer cents."""
+
+    if s[-3:-2] == ',':
+        # Exports write two decimals, the digits are the cents
+        cents = int(s.replace('.', '').replace(',', ''))
+    else:
+        units, _, fraction = s.replace('.', '').partition(',')
+        cents = abs(int(units or '0')) * 100 + int((fraction + '00')[:2])
+        if units.startswith('-'):
+            cents = -cents
+    return -cents if sign == 'Af' else cents
+
+
+def transaction_fingerprint(scope: str, date: date, amount: Decimal,
+                            name: str, comment: str,
+                            occurrence: int = 0) -> bytes:
+    """Compact identity of a bank transaction.
+
+    ``occurrence`` tells apart identical transactions on the same day and
+    ``scope`` (e.g. the journal) keeps separate imports apart.
+    """
+
+    key = '\x1f'.join((scope, date.isoformat(), str(int(amount * 100)),
+                       name, comment, str(occurrence)))
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def parse_dates_batch(values: Sequence[str]):
+    """Parse a column of dates, with a fast path for YYYYMMDD and
+    YYYY-MM-DD.
+
+    Columns that are not entirely in one of those formats are parsed by
+    ``parse_date``. Returns a ``datetime64[D]`` array when NumPy is
+    available and a list of dates otherwise.
+    """
+
+    if np is None:
+        return [parse_date(v) for v in values]
+
+    dates = _parse_fixed_dates(np.asarray(values, dtype=str)) \
+        if len(values) else None
+    if dates is None:
+        dates = np.array([parse_date(v) for v in values],
+                         dtype='datetime64[D]')
+    return dates
+
+
+def _parse_fixed_dates(values):
+    # The characters as code points, ``None`` unless every value has
+    # the same fixed format
+    width = values.dtype.itemsize // 4
+    if width not in (8, 10):
+        return None
+    chars = values.view(np.uint32).reshape(-1, width)
+
+    if width == 10:
+        separators = chars[:, [4, 7]]
+        chars = chars[:, [0, 1, 2, 3, 5, 6, 8, 9]]
+        if (separators != ord('-')).any():
+            return None
+    digits = chars.astype(np.int64) - ord('0')
+    if ((digits < 0) | (digits > 9)).any():
+        return None
+
+    # The digits weighed by their place
+    ints = digits @ 10 ** np.arange(7, -1, -1)
+    months = ints // 100 % 100
+    days = ints % 100
+    if ((months < 1) | (months > 12) | (days < 1)).any():
+        return None
+
+    years = (ints // 10000 - 1970).astype('datetime64[Y]')
+    first = years.astype('datetime64[M]') + \
+        (months - 1).astype('timedelta64[M]')
+    dates = first.astype('datetime64[D]') + (days - 1).astype('timedelta64[D]')
+    # Days past the end of the month roll over into the next one
+    if (dates.astype('datetime64[M]') != first).any():
+        return None
+    return dates
+
+
+def parse_cents_batch(values: Sequence[str],
+                      signs: Optional[Sequence[str]] = None):
+    """Parse a column of Dutch formatted amounts into integer cents.
+
+    ``signs`` is the matching 'Af Bij' column. Returns an int64 array when
+    NumPy is available and a list of ints otherwise.
+    """
+
+    # Variable width amounts parse faster per value than with np.char
+    if signs is None:
+        cents = [parse_cents(v) for v in values]
+    else:
+        cents = [parse_cents(v, sign) for v, sign in zip(values, signs)]
+    return cents if np is None else np.array(cents, dtype=np.int64)
+
+
+class Schema(NamedTuple):
+    """Columns of a bank export format.
+
+    Transaction exports name their ``amount`` column, value exports (like
+    Meesman's) leave it out and have a value column per fund instead.
+    ``detect`` lists further columns that tell the format apart.
+    """
+
+    name: str
+    date: str
+    amount: Optional[str] = None
+    sign: Optional[str] = None
+    counterparty: Optional[str] = None
+    description: Optional[str] = None
+    account: Optional[AssetAccounts] = None
+    detect: Tuple[str, ...] = ()
+
+    @property
+    def columns(self) -> List[str]:
+        return [c for c in (self.date, self.amount, self.sign,
+                            self.counterparty, self.description) if c]
+
+    def matches(self, header: Sequence[str]) -> bool:
+        return set(self.columns).union(self.detect) <= set(header)
+
+
+SCHEMAS: List[Schema] = []
+
+
+def register_schema(schema: Schema) -> Schema:
+    """Make ``detect_schema`` recognize an export format."""
+
+    SCHEMAS.append(schema)
+    return schema
+
+
+ING_PAYMENT = register_schema(Schema(
+    'ING payment account', date='Datum', amount='Bedrag (EUR)',
+    sign='Af Bij', counterparty='Naam / Omschrijving',
+    description='Mededelingen',
+    account=AssetAccounts.BANK_PAYMENT_ACCOUNT))
+ING_SAVINGS = register_schema(Schema(
+    'ING savings', date='Datum', amount='Bedrag', sign='Af Bij',
+    counterparty='Omschrijving', description='Mededelingen',
+    account=AssetAccounts.BANK_SAVINGS, detect=('Rekening naam',)))
+# Any export with a Date column and fund value columns, so it comes last
+MEESMAN = register_schema(Schema('Meesman fund values', date='Date'))
+
+
+def detect_schema(header: Sequence[str]) -> Schema:
+    for schema in SCHEMAS:
+        if schema.matches(header):
+            return schema
+    raise ValueError('Unknown export format, the known formats are: ' +
+                     ', '.join(s.name for s in SCHEMAS))
+
+
+class ColumnBatch(NamedTuple):
+    """Typed columns of consecutive transactions of an export.
+
+    ``dates`` is a ``datetime64[D]`` array and ``cents`` an int64 array
+    when NumPy is available, lists otherwise. Counterparties are interned,
+    as the same few occur over and over.
+    """
+
+    dates: Sequence
+    cents: Sequence[int]
+    counterparties: List[str]
+    descriptions: List[str]
+
+    def transactions(self) -> Iterator[Tuple[date, Decimal, str, str]]:
+        """Yield the date, amount, counterparty and description of every
+        transaction."""
+
+        dates = self.dates.tolist() if np is not None else self.dates
+        cents = self.cents.tolist() if np is not None else self.cents
+        for d, c, counterparty, description in zip(
+                dates, cents, self.counterparties, self.descriptions):
+            yield d, Decimal(c).scaleb(-2), counterparty, description
+
+
+class Ingest:
+    """Reads a bank export of any registered format in a single pass.
+
+    The format is detected from the header unless ``schema`` is given.
+    Transaction exports are read in batches of typed columns, or row by
+    row for consumers that handle one transaction at a time; value
+    exports as a series per value column.
+    """
+
+    def __init__(self, f: TextIO, schema: Optional[Schema] = None) -> None:
+        self.csv = MappedCSV(f)
+        self.schema = schema or detect_schema(self.csv.header)
+
+    def _columns(self) -> List[str]:
+        schema = self.schema
+        if schema.amount is None:
+            raise ValueError(f'{schema.name} exports have no transactions')
+
+        columns = [schema.date, schema.amount, schema.sign,
+                   schema.counterparty, schema.description]
+        return [c for c in columns if c]
+
+    def rows(self) -> Iterator[Tuple[str, ...]]:
+        """Yield the unparsed columns of every transaction that
+        ``transactions`` uses."""
+
+        return self.csv.rows(self._columns())
+
+    def transactions(self, rows: Optional[Iterable[Tuple[str, ...]]] = None) \
+            -> Iterator[Tuple[date, Decimal, str, str]]:
+        """Yield the date, amount, counterparty and description of every
+        transaction, parsed row by row.
+
+        ``rows`` are the rows of ``rows()``, passed in to e.g. time the
+        reading separately.
+        """
+
+        schema = self.schema
+        used = self._columns()
+        at = {column: i for i, column in enumerate(used)}
+        sign, counterparty, description = (
+            at.get(schema.sign), at.get(schema.counterparty),
+            at.get(schema.description))
+
+        # Skips building column lists, which only pays off for batches
+        for row in self.rows() if rows is None else rows:
+            yield (parse_date(row[0]),
+                   parse_amount(row[1], 'Bij' if sign is None else row[sign]),
+                   '' if counterparty is None else row[counterparty],
+                   '' if description is None else row[description])
+
+    def batches(self, size: int = 65536) -> Iterator[ColumnBatch]:
+        schema = self.schema
+        used = self._columns()
+        for batch in self.csv.batches(used, size):
+            values = dict(zip(used, batch))
+            count = len(batch[0])
+            yield ColumnBatch(
+                parse_dates_batch(values[schema.date]),
+                parse_cents_batch(values[schema.amount],
+                                  values.get(schema.sign)),
+                [sys.intern(v) for v in
+                 values.get(schema.counterparty, [''] * count)],
+                values.get(schema.description, [''] * count))
+
+    def series(self) -> Dict[str, Tuple[Sequence, Sequence[int]]]:
+        """Dates and cents of every value column, blanks left out."""
+
+        schema = self.schema
+        funds = [c for c in self.csv.header if c != schema.date]
+        columns: Dict[str, Tuple[List[str], List[str]]] = \
+            {fund: ([], []) for fund in funds}
+
+        for row in self.csv.rows([schema.date] + funds):
+            for fund, value in zip(funds, row[1:]):
+                if value.strip():
+                    dates, values = columns[fund]
+                    dates.append(row[0])
+                    values.append(value)
+
+        return {fund: (parse_dates_batch(dates), parse_cents_batch(values))
+                for fund, (dates, values) in columns.items()}
+
+
+def _reverse_stable(items: List[T], key: Callable[[T], Any]) -> List[T]:
+    # Reverse a non-increasing list while keeping items with equal keys in
+    # their original order, which is what a stable sort would produce.
+    result: List[T] = []
+    end = len(items)
+    while end > 0:
+        start = end - 1
+        k = key(items[start])
+        while start > 0 and key(items[start - 1]) == k:
+            start -= 1
+        result.extend(items[start:end])
+        end = start
+    return result
+
+
+def _sort_run(items: List[T], key: Callable[[T], Any],
+              ascending: bool, descending: bool) -> List[T]:
+    if ascending:
+        return items
+    if descending:
+        return _reverse_stable(items, key)
+    items.sort(key=key)
+    return items
+
+
+def _spill(items: List[T]) -> BinaryIO:
+    f = tempfile.TemporaryFile()
+    for item in items:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _read_run(f: BinaryIO) -> Iterator[T]:
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def sorted_stream(items: Iterable[T], key: Callable[[T], Any],
+                  buffer_size: int = 100000) -> Iterator[T]:
+    """Stable sort of ``items`` by ``key`` with bounded memory.
+
+    At most ``buffer_size`` items are kept in memory, larger inputs are
+    written to temporary files as sorted runs and merged. Runs that are
+    already in ascending or descending order are not sorted at all.
+    """
+
+    runs: List[BinaryIO] = []
+    buffer: List[T] = []
+    ascending = descending = True
+    last = None
+
+    for item in items:
+        k = key(item)
+        if buffer:
+            ascending = ascending and last <= k
+            descending = descending and last >= k
+        buffer.append(item)
+        last = k
+
+        if len(buffer) >= buffer_size:
+            runs.append(_spill(_sort_run(buffer, key, ascending, descending)))
+            buffer = []
+            ascending = descending = True
+
+    buffer = _sort_run(buffer, key, ascending, descending)
+    if not runs:
+        yield from buffer
+        return
+
+    if buffer:
+        runs.append(_spill(buffer))
+        buffer = []
+
+    # heapq.merge prefers earlier runs on equal keys, keeping the sort stable
+    yield from heapq.merge(*(_read_run(f) for f in runs), key=key)
+
+
+def prefetch(items: Iterable[T], size: int) -> Iterator[T]:
+    """Produce ``items`` on a background thread, at most ``size`` ahead.
+
+    An exception of the producer is raised in the consumer. When the
+    consumer stops early, the producer stops at its next item and closes
+    ``items`` on its own thread.
+    """
 
-        s += "\n"
+    results: queue.Queue = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
 
-        for account in [self.account1, self.account2,
-                        self.account3, self.account4]:
-            if account:
-                s += "    {:<40s}€{:.2f}\n".format(account.name.value,
-                                                   account.value)
+    def put(result) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-        s += "\n"
-        return s
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
 
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = results.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()